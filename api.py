@@ -4,39 +4,115 @@ This can also contain game logic. For more complex games it would be wise to
 move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
+import time
+_load_started = time.time()
 
 import endpoints
 from protorpc import remote, messages
+from google.appengine.ext import ndb
 
 from models.user import User, UserNameForm, UserAverageForms
-from models.game import Game, GameForm, GameForms
-from models.card import Card, CardForms
+from models.game import Game, GameForm, GameForms, CreateGamesForm, GameKeysForm
+from models.card import Card, CardForms, MAX_PAIR_COUNT
 from models.history import History, HistoryForms
 from models.score import Score, ScoreForms
-from models.message_form import MatchResultForm, MakeMatchForm, StringMessage
+from models.rank import RankShard, UserRankForm
+from models.session import GameSession, SessionBusyError
+from models.leaderboard import Leaderboard, HIGH_SCORES, USER_RANKINGS
+from models.message_form import MatchResultForm, MatchResultForms, MakeMatchForm, \
+    MakeMatchesForm, StringMessage
 
 from game_logic import GameLogic
-from utils import get_by_urlsafe
+from utils import get_by_urlsafe, get_by_urlsafe_async, get_key
+from instrumentation import instrumented, log_load_time
 
 CREATE_GAME_REQUEST = endpoints.ResourceContainer(UserNameForm)
+CREATE_GAMES_REQUEST = endpoints.ResourceContainer(CreateGamesForm)
 CANCEL_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    if_none_match=messages.StringField(2))
+GET_GAME_CARD_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    if_none_match=messages.StringField(2),
+    compact=messages.BooleanField(3, default=False))
 GET_GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    page_size=messages.IntegerField(2, default=20),
+    cursor=messages.StringField(3),
+    since_nth=messages.IntegerField(4))
 MAKE_GAME_EASIER_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),
     hint_num=messages.IntegerField(2, default=1))
 MAKE_MATCH_REQUEST = endpoints.ResourceContainer(
     MakeMatchForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_MATCHES_REQUEST = endpoints.ResourceContainer(
+    MakeMatchesForm,
+    urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+MAX_PAGE_SIZE = 100
+# A transaction commits at most 500 entities, the game and one history per
+# match or hint
+MAX_BATCH_MATCHES = 400
+# Cards dealt by one create_games call, 5000 standard boards
+MAX_BULK_CARDS = 5000 * 52
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2, default=20),
+    cursor=messages.StringField(3))
 NUM_LIMIT_REQUEST = endpoints.ResourceContainer(
     number_of_results=messages.IntegerField(1, default=10),)
 
 
+def get_user_and_page(user_name, get_page_async):
+    """Read a user by name and a page of its entities concurrently.
+    get_page_async is called with the key of the user and returns a Future
+    of a page and its next cursor. Returns the user, page and next cursor.
+    Raises a NotFoundException if the user does not exist"""
+    if not user_name:
+        raise endpoints.NotFoundException('A User with that name does not exist!')
+    user_future = User.get_by_name_async(user_name)
+    page_future = get_page_async(ndb.Key(User, user_name))
+    user = user_future.get_result()
+    if not user:
+        raise endpoints.NotFoundException('A User with that name does not exist!')
+    if user.key != ndb.Key(User, user_name):
+        # A user not yet re-keyed by /tasks/migrate_user_keys
+        page_future = get_page_async(user.key)
+    page, next_cursor = page_future.get_result()
+    return user, page, next_cursor
+
+
+def close_session(game):
+    """Close the hot session of a game before it is changed outside of it and
+    return its latest state. Raises a ConflictException while its moves
+    are still being saved"""
+    game = GameSession.close(game)
+    if game.hot_session and GameSession.get(game.key) is not None:
+        raise endpoints.ConflictException('Game is being saved, try again.')
+    return game
+
+
+def check_page_size(page_size):
+    """Raise a BadRequestException unless 0 < page_size <= MAX_PAGE_SIZE"""
+    if page_size <= 0 or page_size > MAX_PAGE_SIZE:
+        raise endpoints.BadRequestException(
+            'Page_size must be between 1 and {}!'.format(MAX_PAGE_SIZE))
+
+
+def check_guess(game, pair_1, pair_2):
+    """Raise a ForbiddenException unless the guess indexes are two different
+    cards of the game"""
+    if pair_1 == pair_2:
+        raise endpoints.ForbiddenException('Illegal action: Two guess index must be different!')
+    if pair_1 < 0 or pair_2 < 0 or pair_1 >= game.card_count or pair_2 >= game.card_count:
+        raise endpoints.ForbiddenException(
+            'Illegal action: Guess num must between 0 and {}!'.format(game.card_count))
+
+
 @endpoints.api(name='match_match_game', version='v1')
 class MatchMatchApi(remote.Service):
     """Game API"""
@@ -45,13 +121,14 @@ class MatchMatchApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if not request.user_name:
+            raise endpoints.BadRequestException('User_name is required!')
+        if not User.create(request.user_name, request.email):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -61,28 +138,64 @@ class MatchMatchApi(remote.Service):
                       path='game',
                       name='create_game',
                       http_method='POST')
+    @instrumented
     def create_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
 
-        game = Game.new_game(user)
+        if request.pair_count < 2 or request.pair_count > MAX_PAIR_COUNT:
+            raise endpoints.BadRequestException(
+                'Pair_count must be between 2 and {}!'.format(MAX_PAIR_COUNT))
+
+        game = Game.new_game(user, request.pair_count, request.hot_session)
         game.put()
-        return game.to_form('Good luck playing match-match!')
+        return game.to_form('Good luck playing match-match!', user.name)
 
 
+    @endpoints.method(request_message=CREATE_GAMES_REQUEST,
+                      response_message=GameKeysForm,
+                      path='games',
+                      name='create_games',
+                      http_method='POST')
+    @instrumented
+    def create_games(self, request):
+        """Creates games_per_user new games for each user in user_names"""
+        if request.pair_count < 2 or request.pair_count > MAX_PAIR_COUNT:
+            raise endpoints.BadRequestException(
+                'Pair_count must be between 2 and {}!'.format(MAX_PAIR_COUNT))
+        if request.games_per_user <= 0 or not request.user_names or \
+                len(request.user_names) * request.games_per_user * request.pair_count * 2 > \
+                MAX_BULK_CARDS:
+            raise endpoints.BadRequestException(
+                'Total number of cards must be between 1 and {}!'.format(MAX_BULK_CARDS))
+
+        start = time.time()
+        users = User.get_by_names(request.user_names)
+        missing = [name for name, user in zip(request.user_names, users) if not user]
+        if missing:
+            raise endpoints.NotFoundException(
+                'Users {} do not exist!'.format(', '.join(missing)))
+
+        keys = Game.new_games(users, request.games_per_user, request.pair_count)
+        elapsed = time.time() - start
+        return GameKeysForm(urlsafe_keys=[k.urlsafe() for k in keys],
+                            games_per_second=len(keys) / elapsed if elapsed else None)
+
     @endpoints.method(request_message=CANCEL_GAME_REQUEST,
                       response_message=GameForm,
                       path='cancel_game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @instrumented
     def cancel_game(self, request):
         """Cancel an unfinished game."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
+        game = close_session(game)
         if game.game_over:
             raise endpoints.ForbiddenException('Illegal action: Can\'t cancel a completed game!')
 
@@ -95,158 +208,248 @@ class MatchMatchApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
-        """Return the current game state."""
+        """Return the current game state. If if_none_match is the etag of
+        the current state, only the etag is returned with not_modified."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            return game.to_form('Time to make a match!')
-        else:
+        if not game:
             raise endpoints.NotFoundException('Game not found!')
+        game = GameSession.current(game)
+        if request.if_none_match == game.etag:
+            return GameForm(urlsafe_key=request.urlsafe_game_key, message='Not modified',
+                            etag=game.etag, not_modified=True)
+        return game.to_form('Time to make a match!')
 
     @endpoints.method(request_message=MAKE_MATCH_REQUEST,
                       response_message=MatchResultForm,
                       path='game/{urlsafe_game_key}',
                       name='make_match',
                       http_method='PUT')
+    @instrumented
     def make_match(self, request):
         """Makes a match. Returns matched cards' state with message"""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
+        game = GameSession.current(game)
         if game.game_over:
             raise endpoints.ForbiddenException('Illegal action: Game is already over.')
 
         pair_1 = request.guess_pair_1
         pair_2 = request.guess_pair_2
-        if pair_1 == pair_2:
-            raise endpoints.ForbiddenException('Illegal action: Two guess index must be different!')
-        if pair_1 < 0 or pair_2 < 0 or pair_1 > 51 or pair_2 > 51:
-            raise endpoints.ForbiddenException('Illegal action: Guess num must between 0 and 52!')
+        check_guess(game, pair_1, pair_2)
 
         try:
+            if game.hot_session:
+                return GameLogic.match_pair_hot(game=game, pair_1=pair_1, pair_2=pair_2)
             return GameLogic.match_pair(game=game, pair_1=pair_1, pair_2=pair_2)
-        except RuntimeError:
-            raise endpoints.ForbiddenException('Illegal action: Could not rematch a matched card')
+        except RuntimeError as e:
+            raise endpoints.ForbiddenException('Illegal action: {}'.format(e))
+        except SessionBusyError as e:
+            raise endpoints.ConflictException(str(e))
+
+    @endpoints.method(request_message=MAKE_MATCHES_REQUEST,
+                      response_message=MatchResultForms,
+                      path='game_matches/{urlsafe_game_key}',
+                      name='make_matches',
+                      http_method='PUT')
+    @instrumented
+    def make_matches(self, request):
+        """Makes a list of matches in order. Returns a result for each match,
+        nothing is applied if any match is illegal"""
+        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        game = close_session(game)
+        if game.game_over:
+            raise endpoints.ForbiddenException('Illegal action: Game is already over.')
+        if not request.matches or len(request.matches) > MAX_BATCH_MATCHES:
+            raise endpoints.BadRequestException(
+                'Number of matches must be between 1 and {}!'.format(MAX_BATCH_MATCHES))
+
+        pairs = [(m.guess_pair_1, m.guess_pair_2) for m in request.matches]
+        for pair_1, pair_2 in pairs:
+            check_guess(game, pair_1, pair_2)
+
+        try:
+            return MatchResultForms(items=GameLogic.match_pairs(game=game, pairs=pairs))
+        except RuntimeError as e:
+            raise endpoints.ForbiddenException('Illegal action: {}'.format(e))
 
     @endpoints.method(request_message=MAKE_GAME_EASIER_REQUEST,
                       response_message=HistoryForms,
                       path='make_game_easier/{urlsafe_game_key}',
                       name='make_game_easier',
                       http_method='PUT')
+    @instrumented
     def make_game_easier(self, request):
         """Given a number, automatically match same count of pairs and return match histories"""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
+        game = close_session(game)
         if game.game_over:
             raise endpoints.ForbiddenException('Illegal action: Game is already over.')
 
         hint_num = request.hint_num
         if hint_num <= 0:
             raise endpoints.ForbiddenException('Illegal action: Can not receive a negative number.')
-        if hint_num * 2 >= 52 - game.matched:
+        if hint_num * 2 >= game.card_count - game.matched:
             raise endpoints.ForbiddenException('Illegal action: Can not use hint to win, try a smaller number.')
+        if hint_num > MAX_BATCH_MATCHES:
+            raise endpoints.BadRequestException(
+                'Hint_num must be at most {}!'.format(MAX_BATCH_MATCHES))
 
         hint_histories = GameLogic.make_game_easier(game=game, hint_num=hint_num)
         return HistoryForms(items=[h.to_form() for h in hint_histories])
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=GET_GAME_CARD_REQUEST,
                       response_message=CardForms,
                       path='game_card/{urlsafe_game_key}',
                       name='get_game_card',
                       http_method='GET')
+    @instrumented
     def get_game_card(self, request):
-        """Return card information of given game."""
+        """Return card information of given game. With compact, the board is
+        returned as the packed deck and matched bitmap of the game instead
+        of one item per card. If if_none_match is the etag of the current
+        state, only the etag is returned with not_modified."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
 
+        game = GameSession.current(game)
         if game.game_over:
             raise endpoints.ForbiddenException('Illegal action: Game is already over.')
 
-        cards = Card.get_cards_for_game(game)
-        return CardForms(items=[c.to_form() for c in cards])
+        if request.if_none_match == game.etag:
+            return CardForms(etag=game.etag, not_modified=True)
+        if request.compact:
+            return Card.to_compact_forms(game)
+        cards = game.get_cards()
+        return CardForms(items=[c.to_form() for c in cards], etag=game.etag)
 
     @endpoints.method(request_message=GET_GAME_HISTORY_REQUEST,
                       response_message=HistoryForms,
                       path='game_history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
-        """Return the guess history of given game."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Return a page of the guess history of given game, latest first.
+        With since_nth, return guesses made after the nth, oldest first."""
+        check_page_size(request.page_size)
+        game_future = get_by_urlsafe_async(request.urlsafe_game_key, Game)
+
+        page_future = History.get_game_history_page_async(
+            get_key(request.urlsafe_game_key), request.page_size, request.cursor,
+            request.since_nth)
+        game = game_future.get_result()
         if not game:
             raise endpoints.NotFoundException('Game not found!')
 
-        histories = History.get_game_history(game)
-        return HistoryForms(items=[h.to_form() for h in histories])
-
-    @endpoints.method(request_message=USER_REQUEST,
+        histories, next_cursor = page_future.get_result()
+        # Moves of a hot session not yet written are newer than any page,
+        # they top the first page or end the last one since since_nth
+        last_nth = max([h.nth for h in histories] or [request.since_nth or 0])
+        pending = [h for h in GameSession.pending_histories(game) if h.nth > last_nth]
+        if request.since_nth is None and not request.cursor:
+            histories = pending[::-1] + histories
+        elif request.since_nth is not None and not next_cursor:
+            histories += pending[:request.page_size - len(histories)]
+        return HistoryForms(items=[h.to_form() for h in histories], next_cursor=next_cursor)
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='get_user_active_games',
                       name='get_user_active_games',
                       http_method='GET')
+    @instrumented
     def get_user_active_games(self, request):
-        """Return all of a User's active games."""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                'A User with that name does not exist!')
-        games = Game.get_user_active_games(user)
-        return GameForms(items=[g.to_form(message='User\'s active game') for g in games])
-
-    @endpoints.method(request_message=USER_REQUEST,
+        """Return a page of a User's active games."""
+        check_page_size(request.page_size)
+        user, games, next_cursor = get_user_and_page(
+            request.user_name, lambda user_key: Game.get_user_games_page_async(
+                user_key, False, request.page_size, request.cursor))
+        return Game.to_page_forms(games, user, False, 'User\'s active game', next_cursor)
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='get_user_finished_games',
                       name='get_user_finished_games',
                       http_method='GET')
+    @instrumented
     def get_user_finished_games(self, request):
-        """Return all of a User's active games."""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                'A User with that name does not exist!')
-        games = Game.get_user_finished_games(user)
-        return GameForms(items=[g.to_form(message='User\'s finished game') for g in games])
-
-    @endpoints.method(request_message=USER_REQUEST,
+        """Return a page of a User's finished games."""
+        check_page_size(request.page_size)
+        user, games, next_cursor = get_user_and_page(
+            request.user_name, lambda user_key: Game.get_user_games_page_async(
+                user_key, True, request.page_size, request.cursor))
+        return Game.to_page_forms(games, user, True, 'User\'s finished game', next_cursor)
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                'A User with that name does not exist!')
-        scores = Score.get_user_scores(user)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        """Returns a page of an individual User's scores"""
+        check_page_size(request.page_size)
+        user, scores, next_cursor = get_user_and_page(
+            request.user_name, lambda user_key: Score.get_user_scores_page_async(
+                user_key, request.page_size, request.cursor))
+        return Score.to_page_forms(scores, user, next_cursor)
 
     @endpoints.method(request_message=NUM_LIMIT_REQUEST,
                       response_message=ScoreForms,
                       path='high_scores',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented
     def get_high_scores(self, request):
         """Returns top n highest scores, n is given in request param"""
         limit = request.number_of_results
         if limit <= 0:
             raise endpoints.BadRequestException('Number_of_results must be greater than 0!')
-        scores = Score.get_high_scores(limit=limit)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        scores = Leaderboard.get_top(HIGH_SCORES, limit=limit)
+        return Score.to_forms(scores)
 
     @endpoints.method(request_message=NUM_LIMIT_REQUEST,
                       response_message=UserAverageForms,
                       path='user_rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
         """Returns top n users, n is given in request param"""
         limit = request.number_of_results
         if limit <= 0:
             raise endpoints.BadRequestException('Number_of_results must be greater than 0!')
-        users = User.get_top_users(limit=limit)
+        users = Leaderboard.get_top(USER_RANKINGS, limit=limit)
         return UserAverageForms(items=[u.to_form() for u in users])
 
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserRankForm,
+                      path='user_rank/{user_name}',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented
+    def get_user_rank(self, request):
+        """Returns rank of a User by average attempts, ties share a rank"""
+        histogram_future = RankShard.get_histogram_async()
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        rank, ranked_users = RankShard.rank_in(histogram_future.get_result(),
+                                               user.average_attempts)
+        form = user.to_form()
+        return UserRankForm(user_name=user.name,
+                            rank=rank,
+                            ranked_users=ranked_users,
+                            average_attempts=form.average_attempts)
+
 api = endpoints.api_server([MatchMatchApi])
+log_load_time('api', _load_started)
@@ -0,0 +1,93 @@
+"""harness.py - Run the API in-process against App Engine testbed stubs.
+
+Shared by the benchmark suite and the load generator. The App Engine SDK is
+looked up in the APPENGINE_SDK environment variable, or next to the
+dev_appserver.py found on PATH."""
+
+import os
+import sys
+import time
+from distutils.spawn import find_executable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _find_sdk():
+    sdk = os.environ.get('APPENGINE_SDK')
+    if not sdk:
+        dev_appserver = find_executable('dev_appserver.py')
+        sdk = dev_appserver and os.path.dirname(os.path.realpath(dev_appserver))
+    if not sdk or not os.path.exists(os.path.join(sdk, 'dev_appserver.py')):
+        sys.exit('App Engine SDK not found, set APPENGINE_SDK to its directory')
+    return sdk
+
+sys.path.insert(0, _find_sdk())
+import dev_appserver
+dev_appserver.fix_sys_path()
+sys.path.insert(0, ROOT)
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+
+import instrumentation
+
+
+class Harness(object):
+    """An activated testbed with the API and task handlers loaded"""
+
+    def __init__(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_user_stub()
+        instrumentation.install_hooks()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+        import api
+        import main
+        self.api_module = api
+        self.service = api.MatchMatchApi()
+        self.tasks_app = main.app
+
+    def close(self):
+        self.testbed.deactivate()
+
+    def call(self, method, **fields):
+        """Call an endpoint method of the API with a request built from fields"""
+        endpoint = getattr(self.service, method)
+        return endpoint(endpoint.remote.request_type(**fields))
+
+    def get(self, url):
+        """Send a GET request to the cron and task handlers"""
+        return self.tasks_app.get_response(url)
+
+    def run_tasks(self):
+        """Run queued tasks until the queues are empty, returns how many ran"""
+        count = 0
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks()
+            if not tasks:
+                return count
+            for queue in set(t.queue_name or 'default' for t in tasks):
+                self.taskqueue.FlushQueue(queue)
+            for task in tasks:
+                self.tasks_app.get_response(
+                    task.url, method=task.method, body=task.payload,
+                    headers={'Content-Type': 'application/x-www-form-urlencoded'})
+                count += 1
+
+    def measure(self, name, fn, *args, **kwargs):
+        """Run fn with a cold ndb context cache and return its result and a
+        dict of wall time, datastore RPC count and entities written"""
+        ndb.get_context().clear_cache()
+        start = time.time()
+        with instrumentation.recording(name) as rpcs:
+            result = fn(*args, **kwargs)
+        return result, {'wall_ms': (time.time() - start) * 1000,
+                        'rpcs': sum(s['count'] for s in rpcs.values()),
+                        'entities_written': rpcs.get('Put', {}).get('entities', 0)}
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""load_generator.py - Simulate concurrent players against the API.
+
+Every bot creates a user and plays games with a memory strategy through
+make_match, uses a hint now and then and polls get_game and get_high_scores.
+Bots run in threads, either in-process on the testbed stubs or against a
+running dev server. Throughput, per endpoint latency percentiles, errors,
+transaction contention and retries are reported at the end.
+
+    python benchmarks/load_generator.py --bots 20 --games 3
+    python benchmarks/load_generator.py --url http://localhost:8080 --bots 20
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import urllib
+import urllib2
+from collections import defaultdict
+
+API_PATH = '/_ah/api/match_match_game/v1/'
+# method -> (http method, path template, body fields)
+ROUTES = {
+    'create_user': ('POST', 'user', ()),
+    'create_game': ('POST', 'game', ('user_name', 'pair_count', 'hot_session')),
+    'get_game': ('GET', 'game/{urlsafe_game_key}', ()),
+    'get_game_card': ('GET', 'game_card/{urlsafe_game_key}', ()),
+    'make_match': ('PUT', 'game/{urlsafe_game_key}', ('guess_pair_1', 'guess_pair_2')),
+    'make_game_easier': ('PUT', 'make_game_easier/{urlsafe_game_key}', ()),
+    'get_high_scores': ('GET', 'high_scores', ()),
+}
+RETRIES = 3
+
+
+class CallError(Exception):
+    """An API call failed, status is the HTTP status of the error"""
+    def __init__(self, status, message):
+        super(CallError, self).__init__(message)
+        self.status = status
+
+
+class HttpClient(object):
+    """Calls the API of a running server through its REST paths"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/') + API_PATH
+
+    def call(self, method, **fields):
+        http_method, path, body_fields = ROUTES[method]
+        path = path.format(**fields)
+        body = dict((k, v) for k, v in fields.items() if k in body_fields)
+        query = dict((k, v) for k, v in fields.items()
+                     if k not in body_fields and '{' + k + '}' not in ROUTES[method][1])
+        request = urllib2.Request(self.url + path + ('?' + urllib.urlencode(query) if query else ''),
+                                  data=json.dumps(body) if http_method != 'GET' else None,
+                                  headers={'Content-Type': 'application/json'})
+        request.get_method = lambda: http_method
+        try:
+            return json.loads(urllib2.urlopen(request).read() or '{}')
+        except urllib2.HTTPError as e:
+            raise CallError(e.code, e.read())
+
+    def contention(self):
+        """Failed commits are only counted in-process"""
+        return None
+
+
+class InProcessClient(object):
+    """Calls the API in-process on the testbed stubs, failed datastore
+    commits are counted as transaction contention"""
+
+    def __init__(self):
+        from harness import Harness
+        import endpoints
+        from protorpc import protojson
+        import instrumentation
+        self.harness = Harness()
+        self.endpoints = endpoints
+        self.protojson = protojson
+        self.instrumentation = instrumentation
+        self.failed_commits = 0
+        self.lock = threading.Lock()
+        self.tasks_lock = threading.Lock()
+
+    def call(self, method, **fields):
+        with self.instrumentation.recording(method) as rpcs:
+            try:
+                result = self.harness.call(method, **fields)
+            except self.endpoints.ServiceException as e:
+                raise CallError(e.http_status, str(e))
+            except Exception as e:
+                raise CallError(500, repr(e))
+            finally:
+                with self.lock:
+                    self.failed_commits += rpcs.get('Commit', {}).get('errors', 0)
+        with self.tasks_lock:
+            self.harness.run_tasks()
+        return json.loads(self.protojson.encode_message(result))
+
+    def contention(self):
+        return self.failed_commits
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.retries = 0
+
+    def record(self, method, seconds, status=None):
+        with self.lock:
+            self.latencies[method].append(seconds)
+            if status:
+                self.errors[(method, status)] += 1
+
+
+class Bot(threading.Thread):
+    """A player that remembers every card it has seen"""
+
+    def __init__(self, n, client, stats, games, hint_rate, poll_every):
+        super(Bot, self).__init__(name='bot-{}'.format(n))
+        self.client = client
+        self.stats = stats
+        self.games = games
+        self.hint_rate = hint_rate
+        self.poll_every = poll_every
+        self.user_name = 'bot-{}-{}'.format(n, random.randrange(10 ** 9))
+
+    def call(self, method, **fields):
+        for attempt in range(RETRIES + 1):
+            start = time.time()
+            try:
+                result = self.client.call(method, **fields)
+                self.stats.record(method, time.time() - start)
+                return result
+            except CallError as e:
+                self.stats.record(method, time.time() - start, e.status)
+                # Conflicts and server errors are retried, other errors are final
+                if attempt == RETRIES or e.status not in (409, 500, 503):
+                    raise
+                with self.stats.lock:
+                    self.stats.retries += 1
+
+    def run(self):
+        self.call('create_user', user_name=self.user_name)
+        for _ in range(self.games):
+            try:
+                self.play(self.call('create_game', user_name=self.user_name)['urlsafe_key'])
+            except CallError:
+                pass
+
+    def play(self, key):
+        card_count = len(self.call('get_game_card', urlsafe_game_key=key).get('items', []))
+        seen = {}
+        unmatched = set(range(card_count))
+        moves = 0
+        while unmatched:
+            moves += 1
+            if moves % self.poll_every == 0:
+                self.call('get_game', urlsafe_game_key=key)
+                self.call('get_high_scores', number_of_results=10)
+            if random.random() < self.hint_rate and len(unmatched) > 4:
+                # A hint does not say which indexes it matched, read them back
+                self.call('make_game_easier', urlsafe_game_key=key, hint_num=1)
+                unmatched = set(int(c['index']) for c in self.call(
+                    'get_game_card', urlsafe_game_key=key).get('items', []) if not c['matched'])
+                continue
+            pair_1, pair_2 = self.choose(seen, unmatched)
+            try:
+                result = self.call('make_match', urlsafe_game_key=key,
+                                   guess_pair_1=pair_1, guess_pair_2=pair_2)
+            except CallError:
+                return
+            for card in (result['card_1'], result['card_2']):
+                # Endpoints encodes 64 bit integers as JSON strings
+                seen[int(card['index'])] = int(card['value'])
+            if result['message'] in ('Success', 'Win'):
+                unmatched -= set([pair_1, pair_2])
+            if result['message'] == 'Win':
+                return
+
+    def choose(self, seen, unmatched):
+        """Return a remembered pair if there is one, else an unseen card and
+        another unseen card"""
+        by_value = defaultdict(list)
+        for index in unmatched:
+            if index in seen:
+                by_value[seen[index]].append(index)
+        for indexes in by_value.values():
+            if len(indexes) >= 2:
+                return indexes[0], indexes[1]
+        unseen = [i for i in unmatched if i not in seen] or list(unmatched)
+        first = random.choice(unseen)
+        others = [i for i in unseen if i != first] or [i for i in unmatched if i != first]
+        return first, random.choice(others)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help='base url of a running server, in-process if omitted')
+    parser.add_argument('--bots', type=int, default=10)
+    parser.add_argument('--games', type=int, default=2, help='games per bot')
+    parser.add_argument('--hint-rate', type=float, default=0.02)
+    parser.add_argument('--poll-every', type=int, default=5, help='moves between polls')
+    args = parser.parse_args()
+
+    client = HttpClient(args.url) if args.url else InProcessClient()
+    stats = Stats()
+    bots = [Bot(n, client, stats, args.games, args.hint_rate, args.poll_every)
+            for n in range(args.bots)]
+    start = time.time()
+    for bot in bots:
+        bot.start()
+    for bot in bots:
+        bot.join()
+    elapsed = time.time() - start
+
+    calls = sum(len(v) for v in stats.latencies.values())
+    print('{} bots, {} calls in {:.1f}s, {:.1f} calls/s'.format(
+        args.bots, calls, elapsed, calls / elapsed))
+    print('{:<20} {:>7} {:>9} {:>9} {:>9}'.format('endpoint', 'calls', 'p50_ms', 'p95_ms', 'p99_ms'))
+    for method, latencies in sorted(stats.latencies.items()):
+        print('{:<20} {:>7} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            method, len(latencies), *[percentile(latencies, p) * 1000 for p in (50, 95, 99)]))
+    for (method, status), count in sorted(stats.errors.items()):
+        print('errors {} {}: {}'.format(method, status, count))
+    print('retries: {}'.format(stats.retries))
+    if client.contention() is not None:
+        print('failed transaction commits: {}'.format(client.contention()))
+    if not args.url:
+        client.harness.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""run_benchmarks.py - Benchmark API endpoints on the local testbed.
+
+Each benchmark reports wall time, datastore RPC count and entities written
+per operation. Results are compared against a saved baseline: an operation
+fails if it issues more RPCs or writes more entities than its baseline, or
+if it is slower than its baseline by more than the time tolerance. Without a
+baseline the results are saved as the baseline.
+
+    python benchmarks/run_benchmarks.py [--sizes 10,100] [--save-baseline]
+"""
+
+import argparse
+import json
+import os
+import sys
+from collections import defaultdict
+from datetime import date
+
+from harness import Harness
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def play_game(harness, urlsafe_key, record=None):
+    """Win a game with make_match, one successful match per move"""
+    cards = harness.call('get_game_card', urlsafe_game_key=urlsafe_key).items
+    by_value = defaultdict(list)
+    for card in cards:
+        if not card.matched:
+            by_value[card.value].append(card.index)
+    for indexes in by_value.values():
+        for i in range(0, len(indexes), 2):
+            fields = dict(urlsafe_game_key=urlsafe_key,
+                          guess_pair_1=indexes[i], guess_pair_2=indexes[i + 1])
+            if record:
+                record(lambda: harness.call('make_match', **fields))
+            else:
+                harness.call('make_match', **fields)
+
+
+def seed(harness, size):
+    """Create size users with one finished and one active game each"""
+    for i in range(size):
+        user_name = 'player-{}-{}'.format(size, i)
+        harness.call('create_user', user_name=user_name, email=user_name + '@example.com')
+        finished = harness.call('create_game', user_name=user_name)
+        play_game(harness, finished.urlsafe_key)
+        harness.call('create_game', user_name=user_name)
+    harness.run_tasks()
+
+
+class Runner(object):
+    def __init__(self, harness):
+        self.harness = harness
+        self.results = {}
+
+    def bench(self, name, fn, repeat=1):
+        """Measure fn repeat times and keep the average per operation"""
+        totals = defaultdict(float)
+        for _ in range(repeat):
+            _, stats = self.harness.measure(name, fn)
+            for key, value in stats.items():
+                totals[key] += value
+        self.results[name] = dict((k, v / repeat) for k, v in totals.items())
+
+    def run(self, sizes):
+        h = self.harness
+        h.call('create_user', user_name='bench', email='bench@example.com')
+
+        self.bench('create_game', lambda: h.call('create_game', user_name='bench'), repeat=10)
+
+        game = h.call('create_game', user_name='bench')
+        moves = []
+        play_game(h, game.urlsafe_key, record=lambda fn: moves.append(h.measure('make_match', fn)[1]))
+        self.results['make_match'] = dict(
+            (k, sum(m[k] for m in moves) / len(moves)) for k in moves[0])
+        self.results['playthrough'] = dict((k, sum(m[k] for m in moves)) for k in moves[0])
+        self.bench('record_win', h.run_tasks)
+
+        game = h.call('create_game', user_name='bench')
+        self.bench('make_game_easier', lambda: h.call(
+            'make_game_easier', urlsafe_game_key=game.urlsafe_key, hint_num=5))
+
+        for size in sizes:
+            seed(h, size)
+            finished = h.call('get_user_finished_games', user_name='player-{}-0'.format(size))
+            urlsafe_key = finished.items[0].urlsafe_key
+            self.bench('get_game_history@{}'.format(size), lambda: h.call(
+                'get_game_history', urlsafe_game_key=urlsafe_key))
+            user_name = 'player-{}-0'.format(size)
+            self.bench('get_user_finished_games@{}'.format(size), lambda: h.call(
+                'get_user_finished_games', user_name=user_name), repeat=5)
+            self.bench('get_user_scores@{}'.format(size), lambda: h.call(
+                'get_user_scores', user_name=user_name), repeat=5)
+            self.bench('get_user_rank@{}'.format(size), lambda: h.call(
+                'get_user_rank', user_name=user_name), repeat=5)
+            self.bench('get_high_scores@{}'.format(size), lambda: h.call(
+                'get_high_scores', number_of_results=size), repeat=5)
+            self.bench('get_user_rankings@{}'.format(size), lambda: h.call(
+                'get_user_rankings', number_of_results=size), repeat=5)
+            self.bench('send_reminder@{}'.format(size), lambda: (
+                h.get('/crons/send_reminder'), h.run_tasks()))
+        return self.results
+
+
+def compare(results, baseline, tolerance):
+    """Return descriptions of results that regressed against baseline"""
+    failures = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key in ('rpcs', 'entities_written'):
+            if result[key] > base[key]:
+                failures.append('{}: {} {:.1f} > baseline {:.1f}'.format(name, key, result[key], base[key]))
+        if result['wall_ms'] > base['wall_ms'] * (1 + tolerance):
+            failures.append('{}: wall_ms {:.1f} > baseline {:.1f} + {:.0%}'.format(
+                name, result['wall_ms'], base['wall_ms'], tolerance))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10,100',
+                        help='comma separated numbers of seeded users')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed wall time increase over the baseline')
+    args = parser.parse_args()
+
+    harness = Harness()
+    try:
+        results = Runner(harness).run([int(s) for s in args.sizes.split(',')])
+    finally:
+        harness.close()
+
+    print('{:<28} {:>10} {:>8} {:>10}'.format('operation', 'wall_ms', 'rpcs', 'written'))
+    for name, result in sorted(results.items()):
+        print('{:<28} {:>10.2f} {:>8.1f} {:>10.1f}'.format(
+            name, result['wall_ms'], result['rpcs'], result['entities_written']))
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        # The first run on a machine records the baseline later runs compare to
+        with open(args.baseline, 'w') as f:
+            json.dump({'date': str(date.today()), 'results': results}, f, indent=2, sort_keys=True)
+        print('Baseline saved to {}'.format(args.baseline))
+        return 0
+    with open(args.baseline) as f:
+        failures = compare(results, json.load(f)['results'], args.tolerance)
+    for failure in failures:
+        print('REGRESSION ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
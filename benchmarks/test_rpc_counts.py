@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""test_rpc_counts.py - Check the datastore RPCs of make_match on the testbed.
+
+    python benchmarks/test_rpc_counts.py
+"""
+
+import unittest
+
+from harness import Harness
+import instrumentation
+
+
+class MakeMatchRpcTest(unittest.TestCase):
+    def setUp(self):
+        self.harness = Harness()
+        self.harness.call('create_user', user_name='rpc', email='rpc@example.com')
+        self.game = self.harness.call('create_game', user_name='rpc')
+        # Read the game once so get_by_urlsafe is served by the entity cache
+        self.harness.call('get_game', urlsafe_game_key=self.game.urlsafe_key)
+
+    def tearDown(self):
+        self.harness.close()
+
+    def test_make_match_reads_and_writes_once(self):
+        _, rpcs = self.measure_rpcs(guess_pair_1=0, guess_pair_2=1)
+        self.assertEqual(rpcs['Get']['count'], 1)
+        self.assertEqual(rpcs['Put']['count'], 1)
+        self.assertEqual(rpcs['Commit']['count'], 1)
+        # The game and one history
+        self.assertEqual(rpcs['Put']['entities'], 2)
+
+    def measure_rpcs(self, **fields):
+        with instrumentation.recording('make_match') as rpcs:
+            result = self.harness.call('make_match', urlsafe_game_key=self.game.urlsafe_key,
+                                       **fields)
+        return result, rpcs
+
+
+if __name__ == '__main__':
+    unittest.main()
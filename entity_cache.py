@@ -0,0 +1,109 @@
+"""entity_cache.py - Bounded per-instance LRU cache of versioned entities.
+
+Entities are kept serialized, so every hit returns a fresh copy a caller may
+change. A cached entity carries the version it had when read. Writers of a
+changed entity set its new version in memcache, and a hit is only served if
+that version still matches, which costs one memcache get instead of a
+datastore read. A new entity is saved at version 1 and publishes nothing, as
+no instance can have cached it yet. Reads in a transaction bypass the cache."""
+
+import os
+import threading
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+MAX_BYTES = int(os.environ.get('ENTITY_CACHE_BYTES', 8 * 1024 * 1024))
+# Rough per entry cost of the key, the version and the OrderedDict node
+ENTRY_OVERHEAD = 200
+
+
+class EntityCache(object):
+    """LRU cache of entities by key, bounded by the size of their protobufs"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.adapter = ndb.ModelAdapter()
+        self.hits = self.misses = self.stale = self.evictions = 0
+
+    def get(self, key):
+        """Return the entity of key, from the cache if its version is current"""
+        return self.get_async(key).get_result()
+
+    @ndb.tasklet
+    def get_async(self, key):
+        """Async version of get, returns a Future"""
+        if ndb.in_transaction():
+            entity = yield key.get_async()
+            raise ndb.Return(entity)
+        context = ndb.get_context()
+        version = yield context.memcache_get(_version_key(key))
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[0] == version:
+                self.entries[key] = entry
+                self.hits += 1
+                raise ndb.Return(self.adapter.pb_to_entity(entity_pb.EntityProto(entry[1])))
+            if entry:
+                self.size -= len(entry[1]) + ENTRY_OVERHEAD
+                self.stale += 1
+            else:
+                self.misses += 1
+
+        entity = yield key.get_async()
+        if entity is not None and getattr(entity, 'version', None):
+            if version is None:
+                yield context.memcache_add(_version_key(key), entity.version)
+            self._put(key, entity)
+        raise ndb.Return(entity)
+
+    def _put(self, key, entity):
+        pb_bytes = self.adapter.entity_to_pb(entity).Encode()
+        cost = len(pb_bytes) + ENTRY_OVERHEAD
+        if cost > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= len(old[1]) + ENTRY_OVERHEAD
+            self.entries[key] = (entity.version, pb_bytes)
+            self.size += cost
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted) + ENTRY_OVERHEAD
+                self.evictions += 1
+
+    def get_stats(self):
+        """Return counters and memory use of the cache"""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'stale': self.stale,
+                    'evictions': self.evictions, 'entries': len(self.entries),
+                    'bytes': self.size, 'max_bytes': self.max_bytes}
+
+    def reset_stats(self):
+        """Clear the counters, cached entities are kept"""
+        with self.lock:
+            self.hits = self.misses = self.stale = self.evictions = 0
+
+
+def _version_key(key):
+    return 'version:' + key.urlsafe()
+
+
+def publish_version(entity):
+    """Publish the version of a changed entity so cached copies go stale"""
+    if entity.version > 1:
+        memcache.set(_version_key(entity.key), entity.version)
+
+
+def publish_deleted(key):
+    """Mark cached copies of a deleted entity stale"""
+    memcache.set(_version_key(key), 0)
+
+
+cache = EntityCache(MAX_BYTES)
@@ -1,9 +1,15 @@
 from datetime import date
+import logging
+
+from google.appengine.ext import ndb
 
 from models.game import Game
-from models.card import Card
+from models.user import User
 from models.history import History
 from models.score import Score
+from models.rank import RankShard, RankRebuild, RankRebuildShard
+from models.session import GameSession, SessionBusyError
+from models.leaderboard import Leaderboard, HIGH_SCORES, USER_RANKINGS
 from models.message_form import MatchResultForm
 
 
@@ -13,88 +19,187 @@ class GameLogic:
 
     @classmethod
     def match_pair(cls, game, pair_1, pair_2):
-        """Match a pair and update game state"""
-        game.attempts += 1
-        game.put()
-        card_1 = Card.query(Card.game == game.key).filter(Card.index == pair_1).get()
-        card_2 = Card.query(Card.game == game.key).filter(Card.index == pair_2).get()
+        """Match a pair and update game state.
+        The game is re-read and written back with its history in one
+        transaction, bookkeeping of a won game is left to a task."""
+        return cls.match_pairs(game, [(pair_1, pair_2)])[0]
+
+    @classmethod
+    def match_pairs(cls, game, pairs):
+        """Match a list of pairs in order and return a result form for each.
+        All guesses are applied to one read of the game and written back with
+        their histories in one transaction, an illegal guess rejects them all."""
+        return cls.match_pairs_async(game, pairs).get_result()
+
+    @classmethod
+    def match_pairs_async(cls, game, pairs):
+        """Async version of match_pairs, returns a Future"""
+        Game.pack_legacy_deck(game)
+        return ndb.transaction_async(lambda: cls._match_pairs_txn(game.key, pairs))
+
+    @classmethod
+    @ndb.tasklet
+    def _match_pairs_txn(cls, game_key, pairs):
+        """Transactional part of match_pairs"""
+        game = yield game_key.get_async()
+        forms = []
+        histories = []
+        for pair_1, pair_2 in pairs:
+            form, history = cls._apply_match(game, pair_1, pair_2)
+            forms.append(form)
+            histories.append(history)
+        if game.game_over:
+            # Only needed once a game is won, the module is slow to load
+            from google.appengine.api import taskqueue
+            taskqueue.add(url='/tasks/record_win',
+                          params={'urlsafe_game_key': game_key.urlsafe()},
+                          transactional=True)
+        yield ndb.put_multi_async([game] + histories)
+        raise ndb.Return(forms)
+
+    @classmethod
+    def match_pair_hot(cls, game, pair_1, pair_2):
+        """Match a pair of a game in hot session mode. The move is applied to
+        the memcache session of the game, which is written behind to the
+        datastore, see GameSession"""
+        def move(session):
+            if session.closed:
+                raise SessionBusyError('Game is being saved, try again.')
+            form, history = cls._apply_match(session.game, pair_1, pair_2)
+            session.game.session_version += 1
+            session.histories.append(history)
+            return form
+
+        Game.pack_legacy_deck(game)
+        form, session = GameSession.update(game.key, move)
+        if session.game.game_over:
+            GameSession.close(session.game)
+        elif session.needs_flush():
+            GameSession.flush(session)
+        elif len(session.histories) == 1:
+            GameSession.schedule_flush(game.key)
+        return form
+
+    @classmethod
+    def _apply_match(cls, game, pair_1, pair_2):
+        """Apply a guess to game, returns its result form and unsaved history"""
+        if game.game_over:
+            raise RuntimeError('Game is already over.')
+        card_1 = game.get_card(pair_1)
+        card_2 = game.get_card(pair_2)
 
         if card_1.matched or card_2.matched:
             raise RuntimeError('Could not rematch a matched card')
 
+        game.attempts += 1
         form = MatchResultForm()
         if card_1.value == card_2.value:
             card_1.matched = True
-            card_1.put()
             card_2.matched = True
-            card_2.put()
+            game.set_matched(pair_1)
+            game.set_matched(pair_2)
             game.matched += 2
-            game.put()
             form.message = 'Success'
         else:
             form.message = 'Fail'
 
+        game.game_over = game.matched == game.card_count
+        if game.game_over:
+            form.message = 'Win'
+
         # Construct return info form
         form.card_1 = card_1.to_form()
         form.card_2 = card_2.to_form()
         form.matched_count = game.matched
 
-        if game.matched == 52:
-            game.game_over = True
-            game.put()
-            Card.delete_cards_for_game(game)
-
-            # Update average attempts of user
-            user = game.user.get()
-            games = Game.get_user_finished_games(user)
-            count = len(games)
-            if user.average_attempts == float('inf'):
-                user.average_attempts = 0
-            user.average_attempts = ((count - 1) * user.average_attempts + game.attempts) / count
-            user.put()
-
-            score = Score(user=game.user, date=date.today(), attempts=game.attempts)
-            score.put()
-            form.message = 'Win'
-
         # Create history log
-        History.create_history(game=game,
-                               card_1=card_1,
-                               card_2=card_2,
-                               message=form.message)
-        return form
+        history = History.new_history(game=game,
+                                      card_1=card_1,
+                                      card_2=card_2,
+                                      message=form.message)
+        return form, history
+
+    @classmethod
+    def record_win(cls, game_key):
+        """Update stats of user and record score of a won game.
+        Runs from the task queue, recording a game twice is a no-op."""
+        game = game_key.get()
+        if not game or not game.game_over or game.score_recorded:
+            return
+        user_key = game.user
+
+        @ndb.transactional(xg=True)
+        def txn():
+            shard_key = RankShard.random_key()
+            moves_key = RankRebuildShard.random_key()
+            game, user, shard, rebuild, moves = ndb.get_multi(
+                [game_key, user_key, shard_key, RankRebuild.current_key(), moves_key])
+            if game.score_recorded:
+                return
+            if user is None:
+                # The user was re-keyed by name since the game was read
+                user = game.user_name and ndb.Key(User, game.user_name).get()
+                if not user:
+                    logging.warning('Skipped the win of %s, its user is gone', game_key)
+                    return
+                game.user = user.key
+            score = Score(id=game_key.id(), user=game.user, user_name=user.name,
+                          date=date.today(), attempts=game.attempts)
+            old_average = user.average_attempts
+            user.record_game(score.attempts, score.date)
+            shard = shard or RankShard(key=shard_key)
+            shard.move(old_average, user.average_attempts)
+            game.score_recorded = True
+            entities = [game, user, score, shard]
+            if rebuild and rebuild.counts_user(user.key):
+                entities.append(rebuild.move_counted(moves, moves_key, old_average,
+                                                     user.average_attempts))
+            ndb.put_multi(entities)
+            return user, score
+
+        recorded = txn()
+        if recorded:
+            user, score = recorded
+            futures = [Leaderboard.record_async(HIGH_SCORES, score),
+                       Leaderboard.record_async(USER_RANKINGS, user)]
+            for future in futures:
+                future.check_success()
 
     @classmethod
     def make_game_easier(cls, game, hint_num):
-        cards = Card.get_cards_for_game(game)
-        unmatched_cards = filter(lambda c: not c.matched, cards)
+        """Match hint_num pairs for the player and return their histories.
+        Pairs come from the pair index of the game, the game and all hint
+        histories are written in one transaction"""
+        return cls.make_game_easier_async(game, hint_num).get_result()
+
+    @classmethod
+    def make_game_easier_async(cls, game, hint_num):
+        """Async version of make_game_easier, returns a Future"""
+        Game.pack_legacy_deck(game)
+        return ndb.transaction_async(lambda: cls._make_game_easier_txn(game.key, hint_num))
+
+    @classmethod
+    @ndb.tasklet
+    def _make_game_easier_txn(cls, game_key, hint_num):
+        """Transactional part of make_game_easier"""
+        game = yield game_key.get_async()
         hint_histories = []
 
-        while game.matched != 52 and hint_num > 0:
-            card_1 = unmatched_cards[0]
-            card_2 = filter(lambda c: c != card_1 and c.value == card_1.value, unmatched_cards)[0]
+        while game.matched != game.card_count and hint_num > 0:
+            pair = game.find_hint_pair()
+            card_1 = game.get_card(pair[0])
+            card_2 = game.get_card(pair[1])
             # Update game state
             card_1.matched = True
             card_2.matched = True
+            game.set_matched(card_1.index)
+            game.set_matched(card_2.index)
             game.matched += 2
             game.attempts += 1
             hint_num -= 1
-            # Update card state unmatched card list
-            unmatched_cards.remove(card_1)
-            unmatched_cards.remove(card_2)
-            card_1.put()
-            card_2.put()
             # Create history log
-            history = History.create_history(game=game, card_1=card_1, card_2=card_2, message='Hint Match')
+            history = History.new_history(game=game, card_1=card_1, card_2=card_2, message='Hint Match')
             hint_histories.append(history)
 
-        game.put()
-        return hint_histories
-
-
-
-
-
-
-
-
+        yield ndb.put_multi_async([game] + hint_histories)
+        raise ndb.Return(hint_histories)
@@ -0,0 +1,140 @@
+"""instrumentation.py - Per-endpoint datastore RPC statistics.
+
+Datastore RPCs are counted through apiproxy hooks while a sampled endpoint
+method runs. Stats are aggregated in-process per endpoint and datastore call,
+and each sampled request logs its own stats as one JSON line."""
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+SAMPLE_RATE = float(os.environ.get('RPC_STATS_SAMPLE_RATE', 0.1))
+
+_local = threading.local()
+_lock = threading.Lock()
+# endpoint -> datastore call -> {'count', 'errors', 'entities', 'total_ms', 'max_ms'}
+_stats = {}
+_requests = {}
+
+
+def instrumented(method):
+    """Decorator recording datastore RPCs of an endpoint method for a
+    SAMPLE_RATE fraction of its requests"""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if is_recording() or random.random() >= SAMPLE_RATE:
+            return method(*args, **kwargs)
+        with recording(method.__name__):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def is_recording():
+    """Return whether RPCs of the current thread are being recorded"""
+    return getattr(_local, 'request', None) is not None
+
+
+@contextlib.contextmanager
+def recording(endpoint):
+    """Record datastore RPCs issued by the current thread in the block under
+    endpoint. Yields the stats of the block, a dict of datastore call to
+    {'count', 'errors', 'entities', 'total_ms', 'max_ms'} filled as RPCs
+    complete. A failed Commit is a transaction lost to contention"""
+    _local.request = {}
+    _local.started = {}
+    start = time.time()
+    try:
+        yield _local.request
+    finally:
+        request_stats = _local.request
+        _local.request = None
+        _record_request(endpoint, request_stats, (time.time() - start) * 1000)
+
+
+def get_stats():
+    """Return a copy of the aggregated stats of this instance"""
+    with _lock:
+        return {'sample_rate': SAMPLE_RATE,
+                'requests': dict(_requests),
+                'rpcs': dict((endpoint, dict((call, dict(s)) for call, s in calls.iteritems()))
+                             for endpoint, calls in _stats.iteritems())}
+
+
+def reset_stats():
+    """Clear the aggregated stats of this instance"""
+    with _lock:
+        _stats.clear()
+        _requests.clear()
+
+
+def log_load_time(module_name, started):
+    """Log the time a module took to load since started, a time.time()
+    taken before its first import. Logged as a load_time JSON line"""
+    logging.info('load_time %s', json.dumps({'module': module_name,
+                                             'ms': round((time.time() - started) * 1000, 1)}))
+
+
+def _record_request(endpoint, request_stats, elapsed_ms):
+    with _lock:
+        _requests[endpoint] = _requests.get(endpoint, 0) + 1
+        calls = _stats.setdefault(endpoint, {})
+        for call, s in request_stats.iteritems():
+            total = calls.setdefault(call, _new_call_stats())
+            total['count'] += s['count']
+            total['errors'] += s['errors']
+            total['entities'] += s['entities']
+            total['total_ms'] += s['total_ms']
+            total['max_ms'] = max(total['max_ms'], s['max_ms'])
+    logging.info('rpc_stats %s', json.dumps({'endpoint': endpoint,
+                                             'elapsed_ms': round(elapsed_ms, 1),
+                                             'rpcs': request_stats}, sort_keys=True))
+
+
+def _new_call_stats():
+    return {'count': 0, 'errors': 0, 'entities': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+
+
+def _entity_count(call, request, response):
+    if call in ('Get', 'Delete'):
+        return len(request.key_list())
+    if call == 'Put':
+        return len(request.entity_list())
+    if call in ('RunQuery', 'Next'):
+        return len(response.result_list())
+    return 0
+
+
+def _pre_call_hook(service, call, request, response, rpc=None):
+    if is_recording():
+        _local.started[id(request)] = time.time()
+
+
+def _post_call_hook(service, call, request, response, rpc=None, error=None):
+    if not is_recording():
+        return
+    started = _local.started.pop(id(request), None)
+    elapsed_ms = (time.time() - started) * 1000 if started else 0.0
+    s = _local.request.setdefault(call, _new_call_stats())
+    s['count'] += 1
+    s['total_ms'] += elapsed_ms
+    s['max_ms'] = max(s['max_ms'], elapsed_ms)
+    if error is None:
+        s['entities'] += _entity_count(call, request, response)
+    else:
+        s['errors'] += 1
+
+
+def install_hooks():
+    """Register the RPC hooks on the current apiproxy, does nothing if they
+    are already registered"""
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpc_stats', _pre_call_hook, 'datastore_v3')
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('rpc_stats', _post_call_hook, 'datastore_v3')
+
+install_hooks()
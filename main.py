@@ -2,31 +2,428 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import hashlib
+import json
+import logging
+import os
+import time
+import zlib
+from datetime import date, datetime, timedelta
+_load_started = time.time()
+
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
 from models.user import User
 from models.game import Game
+from models.card import Card
+from models.score import Score
+from models.leaderboard import Leaderboard, BOARDS, LEADERBOARD_SIZE
+from models.rank import RankShard, RankRebuild
+from models.session import GameSession
+from game_logic import GameLogic
+from utils import fetch_page
+import instrumentation
+import entity_cache
+
+REMINDER_BATCH_SIZE = 100
+MIGRATE_BATCH_SIZE = 50
+BACKFILL_BATCH_SIZE = 50
+USER_MIGRATE_BATCH_SIZE = 20
+RANK_REBUILD_BATCH_SIZE = 500
+EXPIRE_BATCH_SIZE = 100
+GAME_TTL_DAYS = int(os.environ.get('GAME_TTL_DAYS', 30))
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+EXPORT_BATCH_SIZE = 50
+EXPORT_RESPONSE_GAMES = 1000
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
+        """Start sending a reminder email to each User with an email about
+        active games. Called every sunday using a cron job"""
+        self.add_task(int(time.time()), 0)
+
+    def post(self):
+        """Enqueue the reminders of one page of users with active games. The
+        next page is enqueued first so pages run in parallel. Each user gets
+        one mail task named by run and user, so a retried page does not mail
+        anyone twice"""
+        start = time.time()
+        run = int(self.request.get('run'))
+        shard = int(self.request.get('shard'))
+        user_keys, cursor = Game.get_active_users_page(
+            REMINDER_BATCH_SIZE, self.request.get('cursor') or None)
+        if cursor:
+            self.add_task(run, shard + 1, cursor)
+
+        tasks = [taskqueue.Task(url='/tasks/send_reminder_mail',
+                                name='reminder-{}-{}'.format(
+                                    run, hashlib.md5(key.urlsafe()).hexdigest()),
+                                params={'urlsafe_user_key': key.urlsafe()})
+                 for key in user_keys]
+        try:
+            # Tasks not yet added are still added if some already exist
+            taskqueue.Queue().add(tasks)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+        logging.info('Reminder shard %d: %d users with active games, enqueued in %.2fs',
+                     shard, len(user_keys), time.time() - start)
+
+    @staticmethod
+    def add_task(run, shard, cursor=None):
+        """Enqueue the task of one page of a reminder run. Tasks are named by
+        run and shard, so a retried task does not enqueue its next page twice"""
+        try:
+            taskqueue.add(url='/tasks/send_reminder',
+                          name='send-reminder-{}-{}'.format(run, shard),
+                          params={'run': run, 'shard': shard, 'cursor': cursor or ''})
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+class SendReminderMail(webapp2.RequestHandler):
+    def post(self):
+        """Send the reminder email of one user, enqueued by SendReminderEmail"""
+        user = ndb.Key(urlsafe=self.request.get('urlsafe_user_key')).get()
+        if not user or not user.email:
+            return
+        # Only needed by the weekly reminders, loaded on first use
+        from google.appengine.api import mail, app_identity
+        subject = 'This is a reminder!'
+        body = 'Hello {}, try out your Match-Match game!'.format(user.name)
+        # This will send test emails, the arguments to send_mail are:
+        # from, to, subject, body
+        mail.send_mail('noreply@{}.appspotmail.com'.format(app_identity.get_application_id()),
+                       user.email,
+                       subject,
+                       body)
+
+
+class RebuildLeaderboards(webapp2.RequestHandler):
+    def get(self):
+        """Rebuild leaderboard snapshots from the datastore to bound the
+        drift of incremental updates. Called every hour using a cron job"""
+        for name in BOARDS:
+            Leaderboard.rebuild(name)
+
+
+class MigrateLegacyCards(webapp2.RequestHandler):
+    def post(self):
+        """Pack Card entities of old games into Game.deck and delete them.
+        Handles one batch of games and enqueues itself until no Card is left.
+        Migrated cards are deleted, so every batch restarts from the top."""
+        cards = Card.query(projection=[Card.game], distinct=True).fetch(MIGRATE_BATCH_SIZE)
+        game_keys = [card.game for card in cards]
+        if not game_keys:
+            logging.info('Legacy card migration finished')
+            return
+
+        games = [g for g in ndb.get_multi(game_keys) if g and g.deck is None]
+        for game in games:
+            Game.pack_legacy_deck(game)
+
+        # Only cards of a packed or a deleted game may go
+        card_keys = []
+        for game_key, game in zip(game_keys, ndb.get_multi(game_keys)):
+            if game is None or game.deck is not None:
+                card_keys.extend(Card.query(Card.game == game_key).fetch(keys_only=True))
+        ndb.delete_multi(card_keys)
+        logging.info('Migrated %d games, deleted %d cards', len(games), len(card_keys))
+        taskqueue.add(url='/tasks/migrate_cards')
+
+
+class RecordWin(webapp2.RequestHandler):
+    def post(self):
+        """Record score and user average of a won game.
+        Enqueued transactionally by the winning make_match."""
+        game_key = ndb.Key(urlsafe=self.request.get('urlsafe_game_key'))
+        GameLogic.record_win(game_key)
+
+
+class FlushSession(webapp2.RequestHandler):
+    def post(self):
+        """Write behind the moves of a hot session that got no move since.
+        Enqueued after the first move following a flush"""
+        game_key = ndb.Key(urlsafe=self.request.get('urlsafe_game_key'))
+        GameSession.flush_scheduled(game_key)
+
+
+class BackfillUserStats(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild the stats aggregate of users from their scores.
+        Handles one page of users and enqueues itself with the next cursor."""
+        cursor = ndb.Cursor(urlsafe=self.request.get('cursor') or None)
+        users, cursor, more = User.query().fetch_page(BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        for user in users:
+            # A win recorded after the scores were read changes the version
+            while user and not _backfill_user_stats(user.key, user.version,
+                                                    Score.get_user_scores(user)):
+                user = user.key.get()
+        logging.info('Backfilled stats of %d users', len(users))
+        if more:
+            taskqueue.add(url='/tasks/backfill_user_stats', params={'cursor': cursor.urlsafe()})
+
+
+@ndb.transactional(xg=True)
+def _backfill_user_stats(user_key, version, scores):
+    """Rebuild the stats of a user from scores read at version and move it
+    in the rank histogram. Returns False if the user changed since"""
+    shard_key = RankShard.random_key()
+    user, shard = ndb.get_multi([user_key, shard_key])
+    if user is None or user.version != version:
+        return False
+    old_average = user.average_attempts
+    user.reset_stats()
+    for score in scores:
+        user.record_game(score.attempts, score.date)
+    shard = shard or RankShard(key=shard_key)
+    shard.move(old_average, user.average_attempts)
+    ndb.put_multi([user, shard])
+    return True
+
+
+class RebuildRankHistogram(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild the rank histogram from the averages of all users. Counts
+        one page of users into a RankRebuild and enqueues itself with the
+        next cursor, the last page swaps the rebuilt histogram in. The name
+        of the first task, which stays the same on a retry, identifies the
+        run"""
+        run_id = self.request.get('run') or self.request.headers['X-AppEngine-TaskName']
+        cursor = self.request.get('cursor') or None
+        users, next_cursor, more = User.query().order(User.key).fetch_page(
+            RANK_REBUILD_BATCH_SIZE, start_cursor=ndb.Cursor(urlsafe=cursor))
+        next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+        if not RankRebuild.add_page(run_id, cursor, users, next_cursor):
+            logging.info('Rank histogram page already counted')
+            return
+        if next_cursor:
+            taskqueue.add(url='/tasks/rebuild_rank_histogram',
+                          params={'run': run_id, 'cursor': next_cursor})
+        else:
+            RankRebuild.finish(run_id)
+            logging.info('Rank histogram rebuilt')
+
+
+class ExpireIdleGames(webapp2.RequestHandler):
+    def get(self):
+        """Start a sweep of active games idle for more than GAME_TTL_DAYS.
+        Called every day using a cron job"""
+        idle_since = datetime.now() - timedelta(days=GAME_TTL_DAYS)
+        taskqueue.add(url='/tasks/expire_games',
+                      params={'idle_since': idle_since.strftime(TIME_FORMAT)})
+
+    def post(self):
+        """Delete one page of idle games and enqueue the next page, carrying
+        the reclaimed entity and byte counts along"""
+        idle_since = datetime.strptime(self.request.get('idle_since'), TIME_FORMAT)
+        entities = int(self.request.get('entities', 0))
+        reclaimed = int(self.request.get('bytes', 0))
+
+        game_keys, cursor = Game.get_idle_games_page(
+            idle_since, EXPIRE_BATCH_SIZE, self.request.get('cursor') or None)
+        deleted_entities, deleted_bytes = Game.expire_games(game_keys, idle_since)
+        entities += deleted_entities
+        reclaimed += deleted_bytes
+
+        if cursor:
+            taskqueue.add(url='/tasks/expire_games',
+                          params={'idle_since': self.request.get('idle_since'),
+                                  'cursor': cursor,
+                                  'entities': entities,
+                                  'bytes': reclaimed})
+        else:
+            logging.info('Expired idle games: reclaimed %d entities, about %d bytes',
+                         entities, reclaimed)
+
+
+class MigrateUserKeys(webapp2.RequestHandler):
+    def post(self):
+        """Re-key users created with a numeric id by their name. Handles one
+        page of users and enqueues itself with the next cursor. Each copied
+        user gets a /tasks/migrate_user_references task, which moves its
+        games and scores and then deletes the old user. Safe to rerun"""
+        users, cursor = fetch_page(User.query(), USER_MIGRATE_BATCH_SIZE,
+                                   self.request.get('cursor') or None)
+        migrated = 0
         for user in users:
-            games = Game.get_user_active_games(user)
-            if len(games) != 0:
-                subject = 'This is a reminder!'
-                body = 'Hello {}, try out your Match-Match game!'.format(user.name)
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                              user.email,
-                               subject,
-                               body)
+            if user.key.id() == user.name:
+                continue
+            new_key = ndb.Key(User, user.name)
+            ndb.transaction(lambda: new_key.get() or User(key=new_key, **user.to_dict()).put())
+            try:
+                taskqueue.add(url='/tasks/migrate_user_references',
+                              name='migrate-user-{}'.format(user.key.id()),
+                              params={'urlsafe_user_key': user.key.urlsafe()})
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                pass
+            migrated += 1
+        logging.info('Re-keyed %d users', migrated)
+        if cursor:
+            taskqueue.add(url='/tasks/migrate_user_keys', params={'cursor': cursor})
+        else:
+            for name in BOARDS:
+                Leaderboard.rebuild(name)
+
+
+class MigrateUserReferences(webapp2.RequestHandler):
+    def post(self):
+        """Point a batch of games, then of scores, of a re-keyed user at its
+        name key, each in its own transaction. Enqueues itself until none
+        is left and then deletes the old user"""
+        old_key = ndb.Key(urlsafe=self.request.get('urlsafe_user_key'))
+        user = old_key.get()
+        if not user:
+            return
+        new_key = ndb.Key(User, user.name)
+        model = Score if self.request.get('kind') == 'Score' else Game
+        # Moved entities no longer match, so each batch starts from the top
+        keys = model.query(model.user == old_key).fetch(USER_MIGRATE_BATCH_SIZE,
+                                                        keys_only=True)
+        for key in keys:
+            if model is Game:
+                game = key.get()
+                if game:
+                    GameSession.close(game)
+            _move_user_reference(key, old_key, new_key)
+        if keys:
+            taskqueue.add(url='/tasks/migrate_user_references',
+                          params={'urlsafe_user_key': old_key.urlsafe(),
+                                  'kind': model.__name__})
+        elif model is Game:
+            taskqueue.add(url='/tasks/migrate_user_references',
+                          params={'urlsafe_user_key': old_key.urlsafe(), 'kind': 'Score'})
+        else:
+            old_key.delete()
+            logging.info('Moved the games and scores of %s to %s', old_key, new_key)
+
+
+@ndb.transactional
+def _move_user_reference(key, old_key, new_key):
+    entity = key.get()
+    if entity and entity.user == old_key:
+        entity.user = new_key
+        entity.put()
+
+
+class ExportPlan(webapp2.RequestHandler):
+    def get(self):
+        """Return the checkpoints to start an export of finished games split
+        into at most shards key ranges, see ExportFinishedGames"""
+        shards = max(1, int(self.request.get('shards', 1)))
+        checkpoints = [_export_checkpoint(start, end, None)
+                       for start, end in Game.get_export_ranges(shards)]
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'checkpoints': checkpoints}))
+
+
+class ExportFinishedGames(webapp2.RequestHandler):
+    def get(self):
+        """Write up to limit finished games of a key range as NDJSON, one
+        game with its score and guess history per line, gzip compressed
+        with gzip=1. Games are read in batches of EXPORT_BATCH_SIZE and
+        written as they are read. The checkpoint to resume from is returned
+        in the X-Export-Checkpoint header, empty once the range is done"""
+        start, end, cursor = _parse_export_checkpoint(self.request.get('checkpoint'))
+        limit = max(1, int(self.request.get('limit', EXPORT_RESPONSE_GAMES)))
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) \
+            if self.request.get('gzip') == '1' else None
+        self.response.headers['Content-Type'] = \
+            'application/gzip' if compressor else 'application/x-ndjson'
+
+        exported = 0
+        while True:
+            game_keys, cursor = Game.get_finished_games_page(
+                start, end, min(EXPORT_BATCH_SIZE, limit - exported), cursor)
+            for record in Game.get_export_records(game_keys):
+                line = json.dumps(record, default=_export_value, sort_keys=True) + '\n'
+                self.response.write(compressor.compress(line) if compressor else line)
+            exported += len(game_keys)
+            if not cursor or exported >= limit:
+                break
+        if compressor:
+            self.response.write(compressor.flush())
+        self.response.headers['X-Export-Checkpoint'] = \
+            _export_checkpoint(start, end, cursor) if cursor else ''
+        logging.info('Exported %d finished games', exported)
+
+
+def _export_checkpoint(start, end, cursor):
+    """Join a key range and query cursor into one string, urlsafe keys and
+    cursors never contain a dot"""
+    return '.'.join([start.urlsafe() if start else '', end.urlsafe() if end else '',
+                     cursor or ''])
+
+
+def _parse_export_checkpoint(checkpoint):
+    """Return the start key, end key and cursor of a checkpoint, an empty
+    checkpoint covers all games"""
+    if not checkpoint:
+        return None, None, None
+    start, end, cursor = checkpoint.split('.')
+    return (ndb.Key(urlsafe=start) if start else None,
+            ndb.Key(urlsafe=end) if end else None,
+            cursor or None)
+
+
+def _export_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Load the API, which builds the endpoints service, and prime the
+        leaderboard and rank caches. Called by App Engine before a new
+        instance serves traffic. Logs the time of each step"""
+        timings = {}
+        start = time.time()
+        import api
+        timings['import_api_ms'] = (time.time() - start) * 1000
+
+        start = time.time()
+        histogram_future = RankShard.get_histogram_async()
+        for name in BOARDS:
+            Leaderboard.get_top(name, LEADERBOARD_SIZE)
+        histogram_future.get_result()
+        timings['prime_caches_ms'] = (time.time() - start) * 1000
+        logging.info('warmup %s', json.dumps(
+            dict((k, round(v, 1)) for k, v in timings.items()), sort_keys=True))
+
+
+class RpcStats(webapp2.RequestHandler):
+    def get(self):
+        """Return datastore RPC stats of endpoints and entity cache counters
+        of this instance as JSON. Pass reset=1 to clear them after reading"""
+        stats = instrumentation.get_stats()
+        stats['entity_cache'] = entity_cache.cache.get_stats()
+        if self.request.get('reset'):
+            instrumentation.reset_stats()
+            entity_cache.cache.reset_stats()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats, sort_keys=True))
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminder_mail', SendReminderMail),
+    ('/crons/rebuild_leaderboards', RebuildLeaderboards),
+    ('/crons/expire_games', ExpireIdleGames),
+    ('/tasks/expire_games', ExpireIdleGames),
+    ('/tasks/migrate_cards', MigrateLegacyCards),
+    ('/tasks/record_win', RecordWin),
+    ('/tasks/flush_session', FlushSession),
+    ('/tasks/backfill_user_stats', BackfillUserStats),
+    ('/tasks/rebuild_rank_histogram', RebuildRankHistogram),
+    ('/tasks/migrate_user_keys', MigrateUserKeys),
+    ('/tasks/migrate_user_references', MigrateUserReferences),
+    ('/admin/rpc_stats', RpcStats),
+    ('/admin/export_plan', ExportPlan),
+    ('/admin/export', ExportFinishedGames),
+    ('/_ah/warmup', Warmup),
 ], debug=True)
+instrumentation.log_load_time('main', _load_started)
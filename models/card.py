@@ -1,11 +1,47 @@
 import random
+import struct
 
 from protorpc import messages
 from google.appengine.ext import ndb
 
+SUITS = ['clubs', 'diamonds', 'spades', 'hearts']
+STANDARD_PAIR_COUNT = 26
+MAX_PAIR_COUNT = 4096
+
+
+def value_count(pair_count):
+    """Return how many values a board of pair_count pairs is dealt from.
+    Every value has a card of each suit, the last one only two if
+    pair_count is odd"""
+    return (pair_count + 1) // 2
+
+
+def code_format(pair_count):
+    """Return the struct format of a packed code or index of a board, one
+    byte per card up to 128 pairs and two bytes above"""
+    return '<B' if value_count(pair_count) * len(SUITS) <= 256 else '<H'
+
+
+def pack(numbers, pair_count):
+    """Pack card codes or indexes of a board into a byte string"""
+    fmt = code_format(pair_count)
+    return struct.pack('<{}{}'.format(len(numbers), fmt[1]), *numbers)
+
+
+def unpack_at(packed, position, pair_count):
+    """Return the number at position of a byte string built by pack"""
+    fmt = code_format(pair_count)
+    return struct.unpack_from(fmt, packed, position * struct.calcsize(fmt))[0]
+
 
 class Card(ndb.Model):
-    """Card object"""
+    """Card object
+
+    Cards of a game are packed into Game.deck, entities of this kind only
+    exist for games dealt before that and are removed by the migration task.
+    Unsaved Card instances are still used to describe a single card.
+    A card is packed as code suit * values + value - 1 where values is the
+    value count of the board, 13 on a standard board."""
     game = ndb.KeyProperty(required=True, kind='Game')
     suit = ndb.StringProperty(required=True)
     value = ndb.IntegerProperty(required=True)
@@ -14,28 +50,66 @@ class Card(ndb.Model):
 
     @classmethod
     def dispatch_cards_for_game(cls, game):
-        """Create a list playing cards shuffled without joker"""
-        cards = []
-        for suit in ['clubs', 'diamonds', 'spades', 'hearts']:
-            for value in range(1, 14):
-                card = Card(game=game.key, suit=suit, value=value)
-                cards.append(card)
-        random.shuffle(cards)
-        for index, card in enumerate(cards):
-            card.index = index
-        ndb.put_multi(cards)
+        """Pack a shuffled deck of game.pair_count pairs into the game"""
+        values = value_count(game.pair_count)
+        codes = [(p % len(SUITS)) * values + p // len(SUITS) for p in range(game.card_count)]
+        random.shuffle(codes)
+        game.deck = pack(codes, game.pair_count)
+        game.matched_cards = str(bytearray((game.card_count + 7) // 8))
+        game.pair_index = cls.build_pair_index(game.deck, game.pair_count)
+
+    @classmethod
+    def build_pair_index(cls, deck, pair_count):
+        """Return indexes of a packed deck grouped by value, the indexes of
+        the cards of a value follow each other in suit order"""
+        values = value_count(pair_count)
+        indexes = [0] * (pair_count * 2)
+        for index in range(pair_count * 2):
+            code = unpack_at(deck, index, pair_count)
+            indexes[code % values * len(SUITS) + code // values] = index
+        return pack(indexes, pair_count)
 
     @classmethod
-    def delete_cards_for_game(cls, game):
-        """Delete cards of given game"""
-        cards = Card.query(Card.game == game.key).fetch()
+    def from_code(cls, game, index, code, matched):
+        """Return an unsaved Card described by its packed code"""
+        values = value_count(game.pair_count)
+        return Card(game=game.key,
+                    suit=SUITS[code // values],
+                    value=code % values + 1,
+                    index=index,
+                    matched=matched)
+
+    @classmethod
+    def pack_legacy_cards(cls, game, cards=None):
+        """Pack Card entities of a standard game dealt before Game.deck existed.
+        cards are queried unless given, which a transaction does not allow"""
+        if cards is None:
+            cards = Card.query(Card.game == game.key).fetch()
+        values = value_count(STANDARD_PAIR_COUNT)
+        codes = [0] * (STANDARD_PAIR_COUNT * 2)
+        matched_cards = bytearray((STANDARD_PAIR_COUNT * 2 + 7) // 8)
         for card in cards:
-            card.key.delete()
+            codes[card.index] = SUITS.index(card.suit) * values + card.value - 1
+            if card.matched:
+                matched_cards[card.index // 8] |= 1 << (card.index % 8)
+        game.pair_count = STANDARD_PAIR_COUNT
+        game.deck = pack(codes, STANDARD_PAIR_COUNT)
+        game.matched_cards = str(matched_cards)
+        game.pair_index = cls.build_pair_index(game.deck, STANDARD_PAIR_COUNT)
+
+    @classmethod
+    def delete_cards_for_game_async(cls, game):
+        """Delete legacy cards of given game, returns the delete futures"""
+        keys = Card.query(Card.game == game.key).fetch(keys_only=True)
+        return ndb.delete_multi_async(keys)
 
     @classmethod
-    def get_cards_for_game(cls, game):
-        """Get cards of given game"""
-        return Card.query(Card.game == game.key).fetch()
+    def to_compact_forms(cls, game):
+        """Returns a CardForms with the board of game as its packed deck and
+        matched bitmap"""
+        game._ensure_deck()
+        return CardForms(deck=game.deck, matched_cards=game.matched_cards,
+                         value_count=value_count(game.pair_count), etag=game.etag)
 
     def to_form(self):
         form = CardForm()
@@ -56,5 +130,11 @@ class CardForm(messages.Message):
 
 
 class CardForms(messages.Message):
-    """Return multiple CardForms"""
+    """Return multiple CardForms, or the compact board: the card codes
+    packed as by pack and the matched bitmap of Game.matched_cards"""
     items = messages.MessageField(CardForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    not_modified = messages.BooleanField(3)
+    deck = messages.BytesField(4)
+    matched_cards = messages.BytesField(5)
+    value_count = messages.IntegerField(6)
@@ -2,65 +2,358 @@ from datetime import date
 
 from protorpc import messages
 from google.appengine.ext import ndb
+from google.appengine.ext.ndb import stats
 
-from card import Card
+from card import Card, SUITS, STANDARD_PAIR_COUNT, value_count, unpack_at
+from history import History
+from score import Score
+from session import GameSession
+import entity_cache
+from utils import fetch_page, fetch_page_async
+
+PUT_BATCH_SIZE = 500
+# Sampled keys per export shard, more samples give more even shards
+EXPORT_SAMPLES_PER_SHARD = 32
+# History entities read in one batch of an export
+EXPORT_HISTORY_BATCH_SIZE = 2000
 
 
 class Game(ndb.Model):
     """Game object"""
     user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty()
     attempts = ndb.IntegerProperty(required=True, default=0)
     matched = ndb.IntegerProperty(required=True, default=0)
     game_over = ndb.BooleanProperty(required=True, default=False)
+    # Set once the score and user average of a won game are recorded
+    score_recorded = ndb.BooleanProperty(default=False)
+    pair_count = ndb.IntegerProperty(default=STANDARD_PAIR_COUNT)
+    # Packed card code of every index, see Card
+    deck = ndb.BlobProperty()
+    # Bitmask of matched indexes, bit i of byte i // 8 is card i
+    matched_cards = ndb.BlobProperty()
+    # Indexes grouped by value, see Card.build_pair_index
+    pair_index = ndb.BlobProperty()
+    # Values before this one have no unmatched card left
+    hint_value = ndb.IntegerProperty(default=0)
+    updated = ndb.DateTimeProperty(auto_now=True)
+    # Moves are kept in a memcache GameSession and written behind
+    hot_session = ndb.BooleanProperty(default=False)
+    # Moves applied through the session as of the last flush
+    session_version = ndb.IntegerProperty(default=0)
+    # Incremented on every put, see entity_cache
+    version = ndb.IntegerProperty(default=0)
+
+    def _pre_put_hook(self):
+        self.version += 1
+
+    def _post_put_hook(self, future):
+        if not future.get_exception():
+            entity_cache.publish_version(self)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        entity_cache.publish_deleted(key)
 
     @classmethod
-    def new_game(cls, user):
-        """Creates and returns a new game"""
-        game = Game(user=user.key)
-        game.put()
+    def new_game(cls, user, pair_count=STANDARD_PAIR_COUNT, hot_session=False):
+        """Creates and returns a new game, the caller is expected to put it"""
+        game = Game(user=user.key, user_name=user.name, pair_count=pair_count,
+                    hot_session=hot_session)
         Card.dispatch_cards_for_game(game)
         return game
 
+    @classmethod
+    def new_games(cls, users, games_per_user, pair_count=STANDARD_PAIR_COUNT):
+        """Creates and puts games_per_user new games for each user. Ids are
+        allocated in one block and games are written in concurrent batches.
+        Returns the keys of the new games"""
+        first, _ = Game.allocate_ids(len(users) * games_per_user)
+        games = []
+        for user in users:
+            for _ in range(games_per_user):
+                game = Game(id=first + len(games), user=user.key, user_name=user.name,
+                            pair_count=pair_count)
+                Card.dispatch_cards_for_game(game)
+                games.append(game)
+        futures = []
+        for start in range(0, len(games), PUT_BATCH_SIZE):
+            futures.extend(ndb.put_multi_async(games[start:start + PUT_BATCH_SIZE]))
+        return [future.get_result() for future in futures]
+
     @classmethod
     def cancel_game(cls, game):
-        """Cancel a game by deleting itself and its cards"""
-        Card.delete_cards_for_game(game)
-        game.key.delete()
+        """Cancel a game by deleting itself and its legacy cards"""
+        futures = [game.key.delete_async()]
+        if game.deck is None:
+            futures.extend(Card.delete_cards_for_game_async(game))
+        ndb.Future.wait_all(futures)
+
+    @classmethod
+    def get_active_users_page(cls, page_size, cursor=None):
+        """Return a page of distinct keys of users with active games and the
+        next cursor"""
+        query = Game.query(Game.game_over == False, projection=[Game.user], distinct=True)
+        games, cursor = fetch_page(query, page_size, cursor)
+        return [g.user for g in games], cursor
+
+    @classmethod
+    def get_idle_games_page(cls, idle_since, page_size, cursor=None):
+        """Return a page of keys of active games not updated since idle_since
+        and the next cursor"""
+        query = Game.query(Game.game_over == False).filter(Game.updated < idle_since)
+        return fetch_page(query, page_size, cursor, keys_only=True)
+
+    @classmethod
+    def expire_games(cls, game_keys, idle_since):
+        """Delete games still idle since idle_since with their histories and
+        legacy cards, keeping games with a live hot session. Returns the
+        number of entities deleted and an estimate of their bytes from the
+        datastore statistics"""
+        expired = []
+        histories = 0
+        for game_key in game_keys:
+            if GameSession.get(game_key) is None:
+                deleted = cls._expire_game(game_key, idle_since)
+                if deleted is not None:
+                    expired.append(game_key)
+                    histories += deleted
+        # Histories saved before they were keyed under their game
+        futures = []
+        for game_key in expired:
+            futures.append(History.query(History.game == game_key).fetch_async(keys_only=True))
+            futures.append(Card.query(Card.game == game_key).fetch_async(keys_only=True))
+        legacy = [key for future in futures for key in future.get_result()
+                  if key.parent() is None]
+        ndb.delete_multi(legacy)
+        cards = sum(1 for key in legacy if key.kind() == 'Card')
+        histories += len(legacy) - cards
+        size = (len(expired) * _average_entity_bytes('Game') +
+                histories * _average_entity_bytes('History') +
+                cards * _average_entity_bytes('Card'))
+        return len(expired) + histories + cards, size
+
+    @classmethod
+    @ndb.transactional
+    def _expire_game(cls, game_key, idle_since):
+        """Delete a game and the histories keyed under it if it is still
+        idle. Returns the number of histories deleted, None if it is not"""
+        game = game_key.get()
+        if not game or game.game_over or game.updated >= idle_since:
+            return None
+        keys = History.query(ancestor=game_key).fetch(keys_only=True)
+        ndb.delete_multi(keys + [game_key])
+        return len(keys)
 
     @classmethod
-    def get_user_active_games(cls, user):
-        """Return all active games of user"""
-        return Game.query(Game.user == user.key).filter(Game.game_over == False).fetch()
+    def get_export_ranges(cls, shards):
+        """Split the keys of games into at most shards ranges holding about
+        the same number of games. Split points are taken from keys sampled
+        in the order of the __scatter__ property the datastore sets on a
+        random subset of entities, with too few samples fewer ranges are
+        returned. Returns a list of (start, end) keys, None is an open end"""
+        samples = ndb.Query(kind='Game').order(ndb.GenericProperty('__scatter__')).fetch(
+            shards * EXPORT_SAMPLES_PER_SHARD, keys_only=True)
+        samples.sort(key=lambda k: k.id())
+        points = sorted(set(samples[len(samples) * i // shards] for i in range(1, shards)),
+                        key=lambda k: k.id()) if samples else []
+        bounds = [None] + points + [None]
+        return zip(bounds[:-1], bounds[1:])
+
+    @classmethod
+    def get_finished_games_page(cls, start, end, page_size, cursor=None):
+        """Return a page of keys of finished games in the key range
+        [start, end) in key order and the next cursor"""
+        query = Game.query(Game.game_over == True)
+        if start:
+            query = query.filter(Game.key >= start)
+        if end:
+            query = query.filter(Game.key < end)
+        return fetch_page(query.order(Game.key), page_size, cursor, keys_only=True)
+
+    @classmethod
+    def get_export_records(cls, game_keys):
+        """Yield a dict of each finished game with its score and full guess
+        history. Games and scores are read in one batch, histories in
+        batches of at most EXPORT_HISTORY_BATCH_SIZE unless a single game
+        has more. Scores written before they were keyed by game are looked
+        up by user and attempts and flagged as score_inferred, a score that
+        is not the only one of its user with as many attempts is None"""
+        game_futures = ndb.get_multi_async(game_keys)
+        scores = ndb.get_multi([ndb.Key(Score, key.id()) for key in game_keys])
+        games = [f.get_result() for f in game_futures]
+        present = [(g, s) for g, s in zip(games, scores) if g]
+        legacy_scores = dict(
+            (i, Score.query(Score.user == g.user, Score.attempts == g.attempts).fetch_async(2))
+            for i, (g, s) in enumerate(present) if s is None)
+        inferred = {}
+        for i, future in legacy_scores.iteritems():
+            matches = future.get_result()
+            inferred[i] = matches[0] if len(matches) == 1 else None
+        present = [(g, inferred[i], True) if i in inferred else (g, s, False)
+                   for i, (g, s) in enumerate(present)]
+
+        while present:
+            batch = [present.pop(0)]
+            attempts = batch[0][0].attempts
+            while present and attempts + present[0][0].attempts <= EXPORT_HISTORY_BATCH_SIZE:
+                attempts += present[0][0].attempts
+                batch.append(present.pop(0))
+            histories = History.get_games_histories([g for g, _, _ in batch])
+            for (game, score, legacy), game_histories in zip(batch, histories):
+                record = game.to_dict(include=['user_name', 'pair_count', 'attempts',
+                                               'matched', 'updated'])
+                record['urlsafe_key'] = game.key.urlsafe()
+                record['score'] = score.to_dict(include=['date', 'attempts']) if score else None
+                record['score_inferred'] = legacy and score is not None
+                record['history'] = [h.to_dict(exclude=['game']) for h in game_histories]
+                yield record
 
     @classmethod
-    def get_user_finished_games(cls, user):
-        """Return all finished games of user"""
-        return Game.query(Game.user == user.key).filter(Game.game_over == True).fetch()
+    def pack_legacy_deck(cls, game):
+        """Pack and save the legacy cards of a game dealt before Game.deck
+        existed. Must run before the game is changed in a transaction, as
+        transactions only allow ancestor queries"""
+        if game.deck is not None:
+            return
+        cards = Card.query(Card.game == game.key).fetch()
 
-    def to_form(self, message):
+        @ndb.transactional
+        def txn():
+            stored = game.key.get()
+            if stored.deck is None:
+                Card.pack_legacy_cards(stored, cards)
+                stored.put()
+        txn()
+
+    def _ensure_deck(self):
+        """Pack legacy Card entities the first time a migrated game is used"""
+        if self.deck is None:
+            Card.pack_legacy_cards(self)
+        elif self.pair_index is None:
+            self.pair_index = Card.build_pair_index(self.deck, self.pair_count)
+
+    @property
+    def etag(self):
+        """Tag of the game state, changed by every put and every move of a
+        hot session"""
+        return '{}.{}'.format(self.version, self.session_version)
+
+    @property
+    def card_count(self):
+        """Number of cards on the board"""
+        return self.pair_count * 2
+
+    def is_matched(self, index):
+        """Return whether the card at index is matched"""
+        self._ensure_deck()
+        return bool(ord(self.matched_cards[index // 8]) & (1 << (index % 8)))
+
+    def set_matched(self, index):
+        """Mark the card at index as matched"""
+        self._ensure_deck()
+        matched_cards = bytearray(self.matched_cards)
+        matched_cards[index // 8] |= 1 << (index % 8)
+        self.matched_cards = str(matched_cards)
+
+    def get_card(self, index):
+        """Return the card at index as an unsaved Card"""
+        self._ensure_deck()
+        code = unpack_at(self.deck, index, self.pair_count)
+        return Card.from_code(self, index, code, self.is_matched(index))
+
+    def find_hint_pair(self):
+        """Return indexes of two unmatched cards of the same value, or None
+        if every card is matched. Matching always takes two cards of a value,
+        so the first value with an unmatched card has a pair left"""
+        self._ensure_deck()
+        while self.hint_value < value_count(self.pair_count):
+            start = self.hint_value * len(SUITS)
+            group = [unpack_at(self.pair_index, position, self.pair_count)
+                     for position in range(start, min(start + len(SUITS), self.card_count))]
+            unmatched = [index for index in group if not self.is_matched(index)]
+            if unmatched:
+                return unmatched[0], unmatched[1]
+            self.hint_value += 1
+        return None
+
+    def get_cards(self):
+        """Return all cards of the game ordered by index"""
+        return [self.get_card(index) for index in range(self.card_count)]
+
+    @classmethod
+    def get_user_games_page_async(cls, user_key, game_over, page_size, cursor=None):
+        """Return a Future of a page of user's active or finished games and
+        the next cursor. Games are projected on the counters a GameForm
+        renders. Takes the key of the user, so the page can be read while
+        the user is"""
+        query = Game.query(Game.user == user_key).filter(Game.game_over == game_over)
+        return fetch_page_async(query, page_size, cursor, projection=[Game.attempts, Game.matched])
+
+    @classmethod
+    def to_page_forms(cls, games, user, game_over, message, next_cursor):
+        """Returns a GameForms representation of a page of projected games"""
+        items = [GameForm(urlsafe_key=g.key.urlsafe(),
+                          user_name=user.name,
+                          attempts=g.attempts,
+                          matched=g.matched,
+                          game_over=game_over,
+                          message=message) for g in games]
+        return GameForms(items=items, next_cursor=next_cursor)
+
+    def to_form(self, message, user_name=None):
         """Returns a GameForm representation of the Game"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.user_name or self.user.get().name
         form.attempts = self.attempts
         form.matched = self.matched
+        form.pair_count = self.pair_count
+        form.hot_session = self.hot_session
         form.game_over = self.game_over
         form.message = message
+        form.etag = self.etag
         return form
 
 
+def _average_entity_bytes(kind):
+    """Return the average size of an entity of kind from the datastore
+    statistics, which are updated about once a day, or 0 before the first"""
+    stat = stats.KindStat.query(stats.KindStat.kind_name == kind).get()
+    return stat.bytes // stat.count if stat and stat.count else 0
+
+
 # ----- Protorpc Message Forms ------
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
     urlsafe_key = messages.StringField(1, required=True)
-    attempts = messages.IntegerField(2, required=True)
-    matched = messages.IntegerField(3, required=True)
-    game_over = messages.BooleanField(4, required=True)
+    # State fields are left out of a not_modified reply
+    attempts = messages.IntegerField(2)
+    matched = messages.IntegerField(3)
+    game_over = messages.BooleanField(4)
     message = messages.StringField(5, required=True)
-    user_name = messages.StringField(6, required=True)
+    user_name = messages.StringField(6)
+    pair_count = messages.IntegerField(7)
+    hot_session = messages.BooleanField(8)
+    etag = messages.StringField(9)
+    not_modified = messages.BooleanField(10)
+
+
+class CreateGamesForm(messages.Message):
+    """Used to create games for a list of users"""
+    user_names = messages.StringField(1, repeated=True)
+    games_per_user = messages.IntegerField(2, default=1)
+    pair_count = messages.IntegerField(3, default=26)
+
+
+class GameKeysForm(messages.Message):
+    """Return keys of created games and the creation throughput"""
+    urlsafe_keys = messages.StringField(1, repeated=True)
+    games_per_second = messages.FloatField(2)
 
 
 class GameForms(messages.Message):
     """Return multiple games"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
@@ -1,6 +1,8 @@
 from protorpc import messages
 from google.appengine.ext import ndb
 
+from utils import fetch_page_async
+
 
 class History(ndb.Model):
     """History object"""
@@ -14,25 +16,54 @@ class History(ndb.Model):
     value_2 = ndb.IntegerProperty(required=True)
 
     @classmethod
-    def create_history(cls, game, card_1, card_2, message):
-        """Create history of guess"""
-        history = History(game=game.key,
-                          nth=game.attempts,
-                          matched=game.matched,
-                          message=message,
-                          suit_1=card_1.suit,
-                          value_1=card_1.value,
-                          suit_2=card_2.suit,
-                          value_2=card_2.value,
-                          )
-        history.put()
-        return history
+    def new_history(cls, game, card_1, card_2, message):
+        """Return an unsaved history of guess, keyed by nth under its game"""
+        return History(parent=game.key,
+                       id=game.attempts,
+                       game=game.key,
+                       nth=game.attempts,
+                       matched=game.matched,
+                       message=message,
+                       suit_1=card_1.suit,
+                       value_1=card_1.value,
+                       suit_2=card_2.suit,
+                       value_2=card_2.value,
+                       )
+
+    @classmethod
+    def get_game_history_page_async(cls, game_key, page_size, cursor=None, since_nth=None):
+        """Return a Future of a page of guess histories of a game and the next
+        cursor. Histories are latest first, or oldest first after since_nth
+        when it is given so a poller only reads the guesses it has not seen
+        yet. Both orders are served by the (game, nth) indexes. Takes the
+        key of the game, so the page can be read while the game is"""
+        query = History.query(History.game == game_key)
+        if since_nth is None:
+            query = query.order(-History.nth)
+        else:
+            query = query.filter(History.nth > since_nth).order(History.nth)
+        return fetch_page_async(query, page_size, cursor)
 
     @classmethod
-    def get_game_history(cls, game):
-        """Return guess histories of game"""
-        histories = History.query(History.game == game.key).fetch()
-        return sorted(histories, key=lambda h: h.nth, reverse=True)
+    def get_games_histories(cls, games):
+        """Return the full guess history of each game, oldest first. Keys of
+        histories follow from the attempts of their game and are read in one
+        batch, games with histories written before that are queried"""
+        keys = [[ndb.Key(History, nth, parent=game.key) for nth in range(1, game.attempts + 1)]
+                for game in games]
+        histories = ndb.get_multi([key for game_keys in keys for key in game_keys])
+        results = []
+        futures = {}
+        start = 0
+        for i, game in enumerate(games):
+            game_histories = histories[start:start + len(keys[i])]
+            start += len(keys[i])
+            if None in game_histories:
+                futures[i] = History.query(History.game == game.key).order(History.nth).fetch_async()
+            results.append(game_histories)
+        for i, future in futures.iteritems():
+            results[i] = future.get_result()
+        return results
 
     def to_form(self):
         """Returns a MatchResultForm representation of the MatchResult"""
@@ -43,6 +74,7 @@ class History(ndb.Model):
         form.card_value_2 = self.value_2
         form.matched_count = self.matched
         form.message = self.message
+        form.nth = self.nth
         return form
 
 
@@ -55,8 +87,10 @@ class HistoryForm(messages.Message):
     card_suit_2 = messages.StringField(4, required=True)
     matched_count = messages.IntegerField(5, required=True)
     message = messages.StringField(6, required=True)
+    nth = messages.IntegerField(7)
 
 
 class HistoryForms(messages.Message):
     """Return multiple histories"""
     items = messages.MessageField(HistoryForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
@@ -0,0 +1,102 @@
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from score import Score
+from user import User
+from utils import get_user_names
+
+LEADERBOARD_SIZE = 100
+# Seconds a cached leaderboard may be served before the snapshot is read again
+CACHE_SECONDS = 60
+
+HIGH_SCORES = 'high_scores'
+USER_RANKINGS = 'user_rankings'
+BOARDS = {
+    HIGH_SCORES: (Score, 'attempts'),
+    USER_RANKINGS: (User, 'average_attempts'),
+}
+
+
+class Leaderboard(ndb.Model):
+    """Snapshot of the top entities of a ranking, keyed by board name.
+    Entries are (urlsafe key, property dict) pairs sorted by the ranking
+    property and always hold the exact top len(entries) entities."""
+    entries = ndb.PickleProperty(default=[])
+    # True when every entity of the ranked kind is in entries
+    complete = ndb.BooleanProperty(default=False)
+    refreshed = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def get_top(cls, name, limit):
+        """Return top n entities of a board as unsaved copies, n = limit.
+        Served from memcache when possible, larger requests query directly"""
+        model, prop = BOARDS[name]
+        if limit > LEADERBOARD_SIZE:
+            return model.query().order(model._properties[prop]).fetch(limit)
+
+        board = memcache.get(cls._cache_key(name))
+        if board is None or (len(board['entries']) < limit and not board['complete']):
+            board = cls.get_by_id(name)
+            if board is None or (len(board.entries) < limit and not board.complete):
+                board = cls.rebuild(name)
+            board = cls._cache(board)
+        return [model(key=ndb.Key(urlsafe=k), **values) for k, values in board['entries'][:limit]]
+
+    @classmethod
+    def rebuild(cls, name):
+        """Rebuild a board snapshot from the datastore"""
+        model, prop = BOARDS[name]
+        entities = model.query().order(model._properties[prop]).fetch(LEADERBOARD_SIZE)
+        if model is Score:
+            user_names = get_user_names(entities)
+            for score in entities:
+                score.user_name = user_names[score.user]
+        board = cls(id=name,
+                     entries=[cls._entry(e) for e in entities],
+                     complete=len(entities) < LEADERBOARD_SIZE)
+        board.put()
+        cls._cache(board)
+        return board
+
+    @classmethod
+    @ndb.tasklet
+    def record_async(cls, name, entity):
+        """Insert or move an entity on a board after its ranking changed,
+        returns a Future. Boards are separate entity groups, so several can
+        be recorded concurrently"""
+        board = yield ndb.transaction_async(lambda: cls._record_txn(name, entity))
+        if board:
+            cls._cache(board)
+
+    @classmethod
+    @ndb.tasklet
+    def _record_txn(cls, name, entity):
+        board = yield cls.get_by_id_async(name)
+        if board is None:
+            raise ndb.Return(None)
+        prop = BOARDS[name][1]
+        key, values = cls._entry(entity)
+        entries = [e for e in board.entries if e[0] != key]
+        if board.complete or (entries and values[prop] <= entries[-1][1][prop]):
+            entries.append((key, values))
+            entries.sort(key=lambda e: e[1][prop])
+        if len(entries) > LEADERBOARD_SIZE:
+            entries = entries[:LEADERBOARD_SIZE]
+            board.complete = False
+        board.entries = entries
+        yield board.put_async()
+        raise ndb.Return(board)
+
+    @classmethod
+    def _entry(cls, entity):
+        return entity.key.urlsafe(), entity.to_dict()
+
+    @classmethod
+    def _cache(cls, board):
+        cached = {'entries': board.entries, 'complete': board.complete}
+        memcache.set(cls._cache_key(board.key.id()), cached, time=CACHE_SECONDS)
+        return cached
+
+    @classmethod
+    def _cache_key(cls, name):
+        return 'leaderboard:' + name
@@ -9,6 +9,11 @@ class MakeMatchForm(messages.Message):
     guess_pair_2 = messages.IntegerField(2, required=True)
 
 
+class MakeMatchesForm(messages.Message):
+    """Used to make a list of matches in an existing game"""
+    matches = messages.MessageField(MakeMatchForm, 1, repeated=True)
+
+
 class MatchResultForm(messages.Message):
     """Used to give result of a match"""
     card_1 = messages.MessageField(CardForm, 1, required=True)
@@ -17,6 +22,11 @@ class MatchResultForm(messages.Message):
     message = messages.StringField(4, required=True)
 
 
+class MatchResultForms(messages.Message):
+    """Used to give results of a list of matches"""
+    items = messages.MessageField(MatchResultForm, 1, repeated=True)
+
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     message = messages.StringField(1, required=True)
\ No newline at end of file
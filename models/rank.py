@@ -0,0 +1,172 @@
+import random
+from collections import defaultdict
+
+from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 20
+# The shards, the moves and the RankRebuild are swapped in one cross-group
+# transaction, which spans at most 25 entity groups
+NUM_REBUILD_SHARDS = 4
+# Width of an average attempts bucket, users in the same bucket share a rank
+BUCKET_WIDTH = 1
+CACHE_KEY = 'rank_histogram'
+CACHE_SECONDS = 10
+
+
+class RankShard(ndb.Model):
+    """One shard of the histogram of ranked users by average attempts bucket.
+    A user is counted in exactly one bucket summed over all shards, the
+    count of a bucket in a single shard may be negative."""
+    counts = ndb.PickleProperty(default={})
+
+    @classmethod
+    def bucket(cls, average_attempts):
+        """Return the bucket of an average, None for a user without games"""
+        if average_attempts == float('inf'):
+            return None
+        return int(average_attempts // BUCKET_WIDTH)
+
+    @classmethod
+    def random_key(cls):
+        """Return the key of a random shard to spread write contention"""
+        return ndb.Key(cls, 'shard-{}'.format(random.randrange(NUM_SHARDS)))
+
+    def move(self, old_average, new_average):
+        """Move a user from the bucket of old_average to that of new_average"""
+        counts = dict(self.counts)
+        old_bucket = self.bucket(old_average)
+        new_bucket = self.bucket(new_average)
+        if old_bucket is not None:
+            counts[old_bucket] = counts.get(old_bucket, 0) - 1
+        if new_bucket is not None:
+            counts[new_bucket] = counts.get(new_bucket, 0) + 1
+        self.counts = counts
+
+    @classmethod
+    @ndb.tasklet
+    def get_histogram_async(cls):
+        """Return a Future of the histogram summed over all shards as a
+        sorted list of (bucket, count), cached in memcache for a few seconds"""
+        context = ndb.get_context()
+        histogram = yield context.memcache_get(CACHE_KEY)
+        if histogram is None:
+            counts = defaultdict(int)
+            keys = [ndb.Key(cls, 'shard-{}'.format(i)) for i in range(NUM_SHARDS)]
+            shards = yield ndb.get_multi_async(keys)
+            for shard in shards:
+                if shard:
+                    for bucket, count in shard.counts.iteritems():
+                        counts[bucket] += count
+            histogram = sorted((b, c) for b, c in counts.iteritems() if c > 0)
+            yield context.memcache_set(CACHE_KEY, histogram, time=CACHE_SECONDS)
+        raise ndb.Return(histogram)
+
+    @classmethod
+    def rank_in(cls, histogram, average_attempts):
+        """Return (rank, ranked user count) of an average in a histogram
+        returned by get_histogram_async"""
+        total = sum(c for _, c in histogram)
+        bucket = cls.bucket(average_attempts)
+        if bucket is None:
+            return None, total
+        return 1 + sum(c for b, c in histogram if b < bucket), total
+
+
+class RankRebuildShard(RankShard):
+    """One shard of the moves of users already counted by a rebuild, kept
+    apart from the RankRebuild so wins don't contend on it. Counts of
+    another run are stale."""
+    run_id = ndb.StringProperty()
+
+    @classmethod
+    def random_key(cls):
+        return ndb.Key(cls, 'shard-{}'.format(random.randrange(NUM_REBUILD_SHARDS)))
+
+
+class RankRebuild(RankShard):
+    """Histogram being rebuilt by a scan of all users in key order, one page
+    per task. Users up to last_user are counted, and their wins move them
+    in a RankRebuildShard as well as in the shards. Once every user is
+    counted the counts and the moves replace the shards. A win between the
+    read of a page and its commit is missed until the next rebuild."""
+    # Tells the tasks of a rebuild apart from those of an earlier one
+    run_id = ndb.StringProperty()
+    # Urlsafe cursor of the next page, None before the first page
+    cursor = ndb.StringProperty()
+    last_user = ndb.KeyProperty(kind='User')
+    done = ndb.BooleanProperty(default=False)
+
+    @classmethod
+    def current_key(cls):
+        return ndb.Key(cls, 'current')
+
+    def counts_user(self, user_key):
+        """Return whether a user is already counted"""
+        return (not self.done and self.last_user is not None
+                and user_key.id() <= self.last_user.id())
+
+    def move_counted(self, shard, shard_key, old_average, new_average):
+        """Move a counted user in the RankRebuildShard of shard_key, read as
+        shard, and return the shard to put"""
+        if shard is None or shard.run_id != self.run_id:
+            shard = RankRebuildShard(key=shard_key, run_id=self.run_id)
+        shard.move(old_average, new_average)
+        return shard
+
+    @classmethod
+    @ndb.transactional
+    def add_page(cls, run_id, cursor, users, next_cursor):
+        """Count a page of users read from cursor, a page without cursor
+        starts the rebuild of run_id. Returns False if the page is already
+        counted"""
+        rebuild = cls.current_key().get()
+        if cursor is None:
+            if rebuild is not None and rebuild.run_id == run_id:
+                return False
+            rebuild = cls(key=cls.current_key(), run_id=run_id)
+        elif rebuild is None or rebuild.run_id != run_id or rebuild.cursor != cursor:
+            return False
+        counts = dict(rebuild.counts)
+        for user in users:
+            bucket = cls.bucket(user.average_attempts)
+            if bucket is not None:
+                counts[bucket] = counts.get(bucket, 0) + 1
+        rebuild.counts = counts
+        rebuild.cursor = next_cursor
+        if users:
+            rebuild.last_user = users[-1].key
+        rebuild.put()
+        return True
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def finish(cls, run_id):
+        """Replace the shards by the rebuilt histogram of run_id"""
+        rebuild = cls.current_key().get()
+        if rebuild is None or rebuild.run_id != run_id or rebuild.done:
+            return
+        counts = dict(rebuild.counts)
+        moves = ndb.get_multi([ndb.Key(RankRebuildShard, 'shard-{}'.format(i))
+                               for i in range(NUM_REBUILD_SHARDS)])
+        for shard in moves:
+            if shard and shard.run_id == run_id:
+                for bucket, count in shard.counts.iteritems():
+                    counts[bucket] = counts.get(bucket, 0) + count
+        shards = [RankShard(id='shard-{}'.format(i)) for i in range(NUM_SHARDS)]
+        shards[0].counts = counts
+        # Kept as done, so a redelivered first page doesn't start over
+        rebuild.done = True
+        rebuild.counts = {}
+        ndb.put_multi(shards + [rebuild])
+        memcache.delete(CACHE_KEY)
+
+
+# ----- Protorpc Message Forms ------
+class UserRankForm(messages.Message):
+    """Return rank of a user among users with finished games"""
+    user_name = messages.StringField(1, required=True)
+    rank = messages.IntegerField(2)
+    ranked_users = messages.IntegerField(3, required=True)
+    average_attempts = messages.StringField(4, required=True)
@@ -1,10 +1,13 @@
 from protorpc import messages
 from google.appengine.ext import ndb
 
+from utils import get_user_names, fetch_page_async
+
 
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty()
     date = ndb.DateProperty(required=True)
     attempts = ndb.IntegerProperty(required=True)
 
@@ -14,16 +17,35 @@ class Score(ndb.Model):
         return Score.query(Score.user == user.key).fetch()
 
     @classmethod
-    def get_high_scores(cls, limit):
-        """Return top n scores, n = limit"""
-        return Score.query().order(Score.attempts).fetch(limit)
+    def get_user_scores_page_async(cls, user_key, page_size, cursor=None):
+        """Return a Future of a page of user scores and the next cursor.
+        Scores are projected on the fields a ScoreForm renders besides the
+        user. Takes the key of the user, so the page can be read while the
+        user is"""
+        query = Score.query(Score.user == user_key)
+        return fetch_page_async(query, page_size, cursor, projection=[Score.date, Score.attempts])
+
+    @classmethod
+    def to_forms(cls, scores):
+        """Returns a ScoreForms representation of scores, users not named
+        on their score are read in one batch"""
+        user_names = get_user_names(scores)
+        return ScoreForms(items=[s.to_form(user_names[s.user]) for s in scores])
 
-    def to_form(self):
+    @classmethod
+    def to_page_forms(cls, scores, user, next_cursor):
+        """Returns a ScoreForms representation of a page of projected scores"""
+        items = [ScoreForm(user_name=user.name,
+                           date=str(s.date),
+                           attempts=s.attempts) for s in scores]
+        return ScoreForms(items=items, next_cursor=next_cursor)
+
+    def to_form(self, user_name=None):
         """Returns a ScoreForm representation of the Score"""
         form = ScoreForm()
         form.attempts = self.attempts
         form.date = str(self.date)
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.user_name or self.user.get().name
         return form
 
 
@@ -38,3 +60,4 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
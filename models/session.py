@@ -0,0 +1,159 @@
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+FLUSH_EVERY_MOVES = 10
+FLUSH_SECONDS = 30
+CAS_RETRIES = 10
+
+
+class SessionBusyError(Exception):
+    """Raised when a session could not be updated because of concurrent moves"""
+
+
+class GameSession(object):
+    """In-progress state of a game played in hot session mode.
+
+    The game and the histories of its moves since the last flush are kept in
+    memcache and updated with compare-and-set. They are written behind to the
+    datastore every FLUSH_EVERY_MOVES moves or FLUSH_SECONDS seconds and when
+    the game is over, and by a task FLUSH_SECONDS after the first move
+    since the last flush. If the session is evicted the game resumes from
+    its last flush. Game.session_version counts moves, so an older flush never
+    overwrites a newer one."""
+
+    def __init__(self, game):
+        self.game = game
+        self.histories = []
+        self.flushed_at = time.time()
+        # Set once the session is being removed, no move is accepted after
+        self.closed = False
+
+    @classmethod
+    def get(cls, game_key):
+        """Return the session of a game or None"""
+        return memcache.get(cls._cache_key(game_key))
+
+    @classmethod
+    def current(cls, game):
+        """Return the latest state of a game, from its session if it has one"""
+        if not game.hot_session:
+            return game
+        session = cls.get(game.key)
+        return session.game if session else game
+
+    @classmethod
+    def update(cls, game_key, mutate):
+        """Apply mutate to the session of a game with compare-and-set. The
+        session is started from the datastore if it is not cached.
+        Returns the result of mutate and the updated session"""
+        client = memcache.Client()
+        cache_key = cls._cache_key(game_key)
+        for _ in range(CAS_RETRIES):
+            session = client.gets(cache_key)
+            if session is None:
+                client.add(cache_key, GameSession(game_key.get()))
+                continue
+            result = mutate(session)
+            if client.cas(cache_key, session):
+                return result, session
+        raise SessionBusyError('Too many concurrent moves, try again.')
+
+    def needs_flush(self):
+        """Return whether the session should be written to the datastore"""
+        return self.game.game_over or len(self.histories) >= FLUSH_EVERY_MOVES or \
+            time.time() - self.flushed_at >= FLUSH_SECONDS
+
+    @classmethod
+    def flush(cls, session):
+        """Write a session to the datastore and drop its flushed histories"""
+        game = session.game
+        histories = session.histories
+
+        @ndb.transactional
+        def txn():
+            stored = game.key.get()
+            if stored is None:
+                # Canceled or expired meanwhile, nothing left to write
+                return
+            entities = list(histories)
+            if stored.session_version < game.session_version:
+                # The session copy may be older than the stored version, and
+                # point at the old key of a user re-keyed meanwhile
+                game.version = stored.version
+                game.user = stored.user
+                entities.append(game)
+                if game.game_over and not stored.game_over:
+                    from google.appengine.api import taskqueue
+                    taskqueue.add(url='/tasks/record_win',
+                                  params={'urlsafe_game_key': game.key.urlsafe()},
+                                  transactional=True)
+            ndb.put_multi(entities)
+        txn()
+
+        flushed_nth = max([h.nth for h in histories] or [0])
+
+        def drop_flushed(s):
+            s.histories = [h for h in s.histories if h.nth > flushed_nth]
+            s.flushed_at = time.time()
+        try:
+            cls.update(game.key, drop_flushed)
+        except SessionBusyError:
+            # Histories have deterministic keys, the next flush rewrites them
+            pass
+
+    @classmethod
+    def pending_histories(cls, game):
+        """Return the histories of the moves of a game not yet written by its
+        session, oldest first"""
+        session = cls.get(game.key) if game.hot_session else None
+        return sorted(session.histories, key=lambda h: h.nth) if session else []
+
+    @classmethod
+    def close(cls, game):
+        """Flush and remove the session of a game before it is changed
+        outside the session. Returns the latest state of the game. If the
+        flush fails the session stays closed until a task flushes it"""
+        if not game.hot_session or cls.get(game.key) is None:
+            return game
+
+        def mark_closed(s):
+            s.closed = True
+        _, session = cls.update(game.key, mark_closed)
+        try:
+            cls.flush(session)
+        except Exception:
+            # Leave the closed session to a task, so a won game still
+            # reaches the datastore and records its win
+            logging.exception('Could not flush the session of %s', game.key)
+            cls.schedule_flush(game.key, countdown=0)
+            return session.game
+        memcache.delete(cls._cache_key(game.key))
+        return session.game
+
+    @classmethod
+    def schedule_flush(cls, game_key, countdown=FLUSH_SECONDS):
+        """Enqueue a flush of the session of a game, so moves are written
+        even if no later move arrives"""
+        from google.appengine.api import taskqueue
+        taskqueue.add(url='/tasks/flush_session',
+                      params={'urlsafe_game_key': game_key.urlsafe()},
+                      countdown=countdown)
+
+    @classmethod
+    def flush_scheduled(cls, game_key):
+        """Run a flush enqueued by schedule_flush, the session of a finished
+        or a closing game is removed"""
+        session = cls.get(game_key)
+        if session is None:
+            return
+        if session.game.game_over or session.closed:
+            cls.close(session.game)
+        elif session.histories:
+            cls.flush(session)
+
+    @classmethod
+    def _cache_key(cls, game_key):
+        return 'session:' + game_key.urlsafe()
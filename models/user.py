@@ -1,27 +1,112 @@
+import os
+
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import entity_cache
+
+# True while users created with a numeric id may remain, see
+# /tasks/migrate_user_keys. Names are then also looked up by query
+LEGACY_USER_KEYS = os.environ.get('LEGACY_USER_KEYS', 'true') == 'true'
+
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile, keyed by name"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
     average_attempts = ndb.FloatProperty(default=float('inf'))
+    # Aggregate of finished games, maintained on every recorded win
+    finished_count = ndb.IntegerProperty(default=0)
+    attempts_total = ndb.IntegerProperty(default=0)
+    best_attempts = ndb.IntegerProperty()
+    worst_attempts = ndb.IntegerProperty()
+    last_played = ndb.DateProperty()
+    # Incremented on every put, see entity_cache
+    version = ndb.IntegerProperty(default=0)
+
+    def _pre_put_hook(self):
+        self.version += 1
+
+    def _post_put_hook(self, future):
+        if not future.get_exception():
+            entity_cache.publish_version(self)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        entity_cache.publish_deleted(key)
+
+    def reset_stats(self):
+        """Clear the stats of the user before they are rebuilt"""
+        self.finished_count = 0
+        self.attempts_total = 0
+        self.best_attempts = None
+        self.worst_attempts = None
+        self.last_played = None
+        self.average_attempts = float('inf')
+
+    def record_game(self, attempts, played):
+        """Add a finished game to the stats of the user"""
+        self.finished_count += 1
+        self.attempts_total += attempts
+        self.best_attempts = min(attempts, self.best_attempts or attempts)
+        self.worst_attempts = max(attempts, self.worst_attempts or attempts)
+        self.last_played = max(played, self.last_played or played)
+        self.average_attempts = float(self.attempts_total) / self.finished_count
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Return the user with given name or None"""
+        return cls.get_by_name_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Async version of get_by_name, returns a Future"""
+        if not name:
+            raise ndb.Return(None)
+        user = yield entity_cache.cache.get_async(ndb.Key(User, name))
+        if user is None and LEGACY_USER_KEYS:
+            user = yield User.query(User.name == name).get_async()
+        raise ndb.Return(user)
+
+    @classmethod
+    def get_by_names(cls, names):
+        """Return users with given names in one batch, None for a missing one"""
+        users = ndb.get_multi([ndb.Key(User, name) for name in names])
+        if LEGACY_USER_KEYS:
+            users = [user or User.query(User.name == name).get()
+                     for name, user in zip(names, users)]
+        return users
+
+    @classmethod
+    def create(cls, name, email):
+        """Create and return a user, or return None if the name is taken"""
+        if LEGACY_USER_KEYS and User.query(User.name == name).get(keys_only=True):
+            return None
+        return cls._create_txn(name, email)
 
     @classmethod
-    def get_top_users(cls, limit):
-        """Return top n users, n = limit"""
-        return User.query().order(User.average_attempts).fetch(limit)
+    @ndb.transactional
+    def _create_txn(cls, name, email):
+        if User.get_by_id(name):
+            return None
+        user = User(id=name, name=name, email=email)
+        user.put()
+        return user
 
     def to_form(self):
         """Returns a UserAverageForm representation of the User"""
         form = UserAverageForm()
         form.user_name = self.name
         form.email = self.email
-        if self.average_attempts == float('inf'):
+        form.finished_count = self.finished_count
+        if not self.finished_count:
             form.average_attempts = 'No game is finished.'
         else:
-            form.average_attempts = str(self.average_attempts)
+            form.average_attempts = str(float(self.attempts_total) / self.finished_count)
+            form.best_attempts = self.best_attempts
+            form.worst_attempts = self.worst_attempts
+            form.last_played = str(self.last_played)
         return form
 
 
@@ -29,6 +114,8 @@ class User(ndb.Model):
 class UserNameForm(messages.Message):
     """Used to create a new game"""
     user_name = messages.StringField(1, required=True)
+    pair_count = messages.IntegerField(2, default=26)
+    hot_session = messages.BooleanField(3, default=False)
 
 
 class UserAverageForm(messages.Message):
@@ -36,6 +123,10 @@ class UserAverageForm(messages.Message):
     user_name = messages.StringField(1, required=True)
     average_attempts = messages.StringField(2, required=True)
     email = messages.StringField(3, required=False)
+    finished_count = messages.IntegerField(4)
+    best_attempts = messages.IntegerField(5)
+    worst_attempts = messages.IntegerField(6)
+    last_played = messages.StringField(7)
 
 
 class UserAverageForms(messages.Message):
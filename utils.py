@@ -4,6 +4,27 @@ import logging
 from google.appengine.ext import ndb
 import endpoints
 
+import entity_cache
+
+# Shown for entities whose user no longer exists, forms require a name
+DELETED_USER_NAME = '[deleted]'
+
+
+def get_key(urlsafe):
+    """Returns the ndb.Key of a urlsafe key string
+    Raises:
+        endpoints.BadRequestException: If the key string is malformed."""
+    try:
+        return ndb.Key(urlsafe=urlsafe)
+    except TypeError:
+        raise endpoints.BadRequestException('Invalid Key')
+    except Exception, e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid Key')
+        else:
+            raise
+
+
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
@@ -17,19 +38,61 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
-    try:
-        key = ndb.Key(urlsafe=urlsafe)
-    except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
-    except Exception, e:
-        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
-        else:
-            raise
+    return get_by_urlsafe_async(urlsafe, model).get_result()
+
 
-    entity = key.get()
+@ndb.tasklet
+def get_by_urlsafe_async(urlsafe, model):
+    """Async version of get_by_urlsafe, returns a Future"""
+    key = get_key(urlsafe)
+    if 'version' in model._properties:
+        entity = yield entity_cache.cache.get_async(key)
+    else:
+        entity = yield key.get_async()
     if not entity:
-        return None
+        raise ndb.Return(None)
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
-    return entity
+    raise ndb.Return(entity)
+
+
+def get_user_names(entities):
+    """Returns a dict mapping user keys to names for entities that reference
+        a User. Names denormalized on the entity are used as they are, the
+        remaining users are resolved with a single get_multi
+    Args:
+        entities: ndb.Model entities with a user key and a user_name property
+    Returns:
+        A dict of user key to user name, DELETED_USER_NAME for a user that
+        no longer exists."""
+    names = dict((e.user, e.user_name) for e in entities if e.user_name)
+    missing = list(set(e.user for e in entities if e.user not in names))
+    for key, user in zip(missing, ndb.get_multi(missing)):
+        names[key] = user.name if user else DELETED_USER_NAME
+    return names
+
+
+def fetch_page(query, page_size, urlsafe_cursor=None, **options):
+    """Returns one page of a query and the cursor of the next page
+    Args:
+        query: An ndb.Query with a deterministic order
+        page_size: Maximum number of results
+        urlsafe_cursor: A urlsafe cursor string returned for a previous page
+        options: Extra query options such as projection
+    Returns:
+        A tuple of the results and the urlsafe cursor of the next page, or
+        None if this is the last page.
+    Raises:
+        endpoints.BadRequestException: If the cursor is malformed."""
+    return fetch_page_async(query, page_size, urlsafe_cursor, **options).get_result()
+
+
+@ndb.tasklet
+def fetch_page_async(query, page_size, urlsafe_cursor=None, **options):
+    """Async version of fetch_page, returns a Future"""
+    try:
+        cursor = ndb.Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor else None
+    except Exception:
+        raise endpoints.BadRequestException('Invalid Cursor')
+    results, cursor, more = yield query.fetch_page_async(page_size, start_cursor=cursor, **options)
+    raise ndb.Return((results, cursor.urlsafe() if more and cursor else None))